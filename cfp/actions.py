@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+import logging
+
+from mailing.utils import send_bulk_messages
+from .models import Talk, Track, Tag, Room
+from .planning import bump_schedule_version
+from .signals import get_message_notifications
+
+
+def apply_talk_actions(conference, talk_ids, author, decision=None, track=None, tag=None, room=None):
+    """
+    Apply the talk list actions to the conference talks with the given pks, in a single transaction.
+    Return the number of talks changed by each action.
+    """
+    site = conference.site
+    report = {'decision': 0, 'track': 0, 'tag': 0, 'room': 0}
+    with transaction.atomic():
+        talks = list(Talk.objects.filter(site=site, pk__in=talk_ids).select_related('conversation', 'site__conference')
+                                 .prefetch_related('site__conference__staff'))
+        if track:
+            track = Track.objects.get(site=site, slug=track)
+        if tag:
+            tag = Tag.objects.get(site=site, slug=tag)
+        if room:
+            room = Room.objects.get(site=site, slug=room)
+        fields = set()
+        changed = []
+        notes = []
+        for talk in talks:
+            modified = False
+            if decision is not None and decision != talk.accepted:
+                if decision:
+                    action = _('accepted')
+                else:
+                    action = _('declined')
+                note = _('The talk has been %(action)s.') % {'action': action}
+                subject = _("[%(conference)s] The talk '%(talk)s' have been %(action)s") % {
+                    'conference': conference,
+                    'talk': talk,
+                    'action': action,
+                }
+                notes.append((talk.conversation, author, subject, note))
+                talk.accepted = decision
+                fields.add('accepted')
+                report['decision'] += 1
+                modified = True
+            if track and talk.track_id != track.pk:
+                talk.track = track
+                fields.add('track')
+                report['track'] += 1
+                modified = True
+            if room and talk.room_id != room.pk:
+                talk.room = room
+                fields.add('room')
+                report['room'] += 1
+                modified = True
+            if modified:
+                # auto_now is not handled by bulk_update
+                talk.updated = timezone.now()
+                changed.append(talk)
+        if changed:
+            Talk.objects.bulk_update(changed, list(fields) + ['updated'], batch_size=500)
+        if tag:
+            tagged = set(Talk.tags.through.objects.filter(tag=tag, talk__in=talks).values_list('talk_id', flat=True))
+            Talk.tags.through.objects.bulk_create([Talk.tags.through(talk=talk, tag=tag) for talk in talks if talk.pk not in tagged],
+                                                  ignore_conflicts=True)
+            report['tag'] = len(talks) - len(tagged)
+        # once committed, so the schedule is not rebuilt from uncommitted rows and no mail is sent for rolled back changes
+        if any(report.values()):
+            transaction.on_commit(lambda: bump_schedule_version(site.pk))
+        if notes:
+            transaction.on_commit(lambda: send_talk_notes(notes))
+    return report
+
+
+def send_talk_notes(notes):
+    # the actions are already committed, a mail server failure must not turn them into an error
+    try:
+        send_bulk_messages(notes, get_message_notifications)
+    except Exception:
+        logging.exception("An error occured while sending the talk notifications")
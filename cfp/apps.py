@@ -8,3 +8,4 @@ class CFPConfig(AppConfig):
     def ready(self):
         import cfp.signals  # noqa
         post_migrate.connect(cfp.signals.call_first_site_post_save, sender=self)
+        post_migrate.connect(cfp.signals.setup_search_index, sender=self)
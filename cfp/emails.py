@@ -1,11 +1,17 @@
 from django.utils.translation import ugettext as _
 from django.utils.html import escape
+from django.db.models import Prefetch
+
+from jinja2.sandbox import SandboxedEnvironment
 
 from pprint import pformat
 from textwrap import indent
 
-from mailing.utils import send_message
-from .environment import TalkEnvironment, SpeakerEnvironment, VolunteerEnvironment
+from mailing.utils import send_bulk_messages
+from .environment import TalkEnvironment, SpeakerEnvironment, VolunteerEnvironment, \
+                         talk_to_dict, speaker_to_dict, volunteer_to_dict
+from .models import Participant, Talk
+from .signals import get_message_notifications
 
 
 def talk_email_render_preview(talk, speaker, subject, body):
@@ -56,35 +62,42 @@ def volunteer_email_render_preview(volunteer, subject, body):
     return preview
 
 
+def compile_email_templates(subject, body):
+    env = SandboxedEnvironment()
+    return env.from_string(subject), env.from_string(body)
+
+
 def talk_email_send(talks, subject, body):
-    sent = 0
-    for talk in talks.all():
-        for speaker in talk.speakers.all():
-            env = TalkEnvironment(talk, speaker)
-            s = env.from_string(subject).render()
-            c = env.from_string(body).render()
-            send_message(speaker.conversation, talk.site.conference, subject=s, content=c)
-            sent += 1
-    return sent
+    subject, body = compile_email_templates(subject, body)
+    talks = talks.select_related('site__conference', 'category', 'track') \
+                 .prefetch_related(Prefetch('speakers', queryset=Participant.objects.select_related('conversation', 'site__conference')))
+
+    def messages():
+        for talk in talks:
+            for speaker in talk.speakers.all():
+                context = {'talk': talk_to_dict(talk, speaker), 'speaker': speaker_to_dict(speaker)}
+                yield speaker.conversation, talk.site.conference, subject.render(context), body.render(context)
+    return send_bulk_messages(messages(), get_message_notifications)
 
 
 def speaker_email_send(speakers, subject, body):
-    sent = 0
-    for speaker in speakers.all():
-        env = SpeakerEnvironment(speaker)
-        s = env.from_string(subject).render()
-        c = env.from_string(body).render()
-        send_message(speaker.conversation, speaker.site.conference, subject=s, content=c)
-        sent += 1
-    return sent
+    subject, body = compile_email_templates(subject, body)
+    talks = Talk.objects.select_related('site__conference', 'category', 'track').prefetch_related('speakers')
+    speakers = speakers.select_related('conversation', 'site__conference').prefetch_related(Prefetch('talk_set', queryset=talks))
+
+    def messages():
+        for speaker in speakers:
+            context = {'speaker': speaker_to_dict(speaker, include_talks=True)}
+            yield speaker.conversation, speaker.site.conference, subject.render(context), body.render(context)
+    return send_bulk_messages(messages(), get_message_notifications)
 
 
 def volunteer_email_send(volunteers, subject, body):
-    sent = 0
-    for volunteer in volunteers.all():
-        env = VolunteerEnvironment(volunteer)
-        s = env.from_string(subject).render()
-        c = env.from_string(body).render()
-        send_message(volunteer.conversation, volunteer.site.conference, subject=s, content=c)
-        sent += 1
-    return sent
+    subject, body = compile_email_templates(subject, body)
+    volunteers = volunteers.select_related('conversation', 'site__conference').prefetch_related('activities')
+
+    def messages():
+        for volunteer in volunteers:
+            context = {'volunteer': volunteer_to_dict(volunteer)}
+            yield volunteer.conversation, volunteer.site.conference, subject.render(context), body.render(context)
+    return send_bulk_messages(messages(), get_message_notifications)
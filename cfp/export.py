@@ -0,0 +1,86 @@
+from django.db.models import F, Case, When
+from django.db.models.functions import Lower
+from django.http import StreamingHttpResponse
+from django.utils.translation import ugettext
+
+from itertools import groupby
+from operator import itemgetter
+import csv
+
+from .models import Participant, Talk, Volunteer
+
+
+CHUNK_SIZE = 2000
+
+
+class Echo:
+    """Pseudo-buffer handing back what the csv writer writes to it."""
+    def write(self, value):
+        return value
+
+
+def csv_response(rows, filename):
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def _related_by_talk(queryset, *fields):
+    # rows are ordered by talk so they can be merged with the talks without keeping them in memory
+    rows = queryset.order_by('talk_id', 'pk').values_list('talk_id', *fields).iterator(chunk_size=CHUNK_SIZE)
+    return groupby(rows, key=itemgetter(0))
+
+
+def talk_csv_rows(talks):
+    pks = talks.values('pk')
+    talks = Talk.objects.filter(pk__in=pks).order_by('pk').annotate(
+        estimated_duration_value=Case(When(duration=0, then=F('category__duration')), default=F('duration')),
+    ).values_list(
+        'pk', 'title', 'description', 'category__name', 'track__name', 'videotaped', 'video_licence', 'sound',
+        'estimated_duration_value', 'room__name', 'plenary', 'materials', 'video',
+    )
+    speakers = _related_by_talk(Talk.speakers.through.objects.filter(talk__in=pks), 'participant_id', 'participant__name')
+    tags = _related_by_talk(Talk.tags.through.objects.filter(talk__in=pks), 'tag__name')
+    speaker_group = next(speakers, None)
+    tag_group = next(tags, None)
+    for pk, title, description, category, track, videotaped, licence, sound, duration, room, plenary, materials, video \
+            in talks.iterator(chunk_size=CHUNK_SIZE):
+        talk_speakers, talk_tags = [], []
+        if speaker_group and speaker_group[0] == pk:
+            talk_speakers = list(speaker_group[1])
+            speaker_group = next(speakers, None)
+        if tag_group and tag_group[0] == pk:
+            talk_tags = list(tag_group[1])
+            tag_group = next(tags, None)
+        yield [
+            pk,
+            title,
+            description,
+            ugettext(category),
+            track,
+            [speaker[1] for speaker in talk_speakers],
+            [speaker[2] for speaker in talk_speakers],
+            [tag[1] for tag in talk_tags],
+            1 if videotaped else 0,
+            licence,
+            1 if sound else 0,
+            duration,
+            room,
+            1 if plenary else 0,
+            materials,
+            video,
+        ]
+
+
+def participant_csv_rows(participants):
+    participants = Participant.objects.filter(pk__in=participants.values('pk')).order_by(Lower('name'), 'pk')
+    fields = ['pk', 'name', 'email', 'biography', 'twitter', 'linkedin', 'github', 'website', 'facebook', 'mastodon', 'phone_number', 'notes']
+    return participants.values_list(*fields).iterator(chunk_size=CHUNK_SIZE)
+
+
+def volunteer_csv_rows(volunteers):
+    volunteers = Volunteer.objects.filter(pk__in=volunteers.values('pk')).order_by('pk')
+    for pk, name, email, phone_number, sms_prefered, notes in volunteers.values_list(
+            'pk', 'name', 'email', 'phone_number', 'sms_prefered', 'notes').iterator(chunk_size=CHUNK_SIZE):
+        yield [pk, name, email, phone_number, 1 if sms_prefered else 0, notes]
@@ -36,6 +36,8 @@ CONFIRMATION_VALUES = [
         ('cancelled', False),
 ]
 
+TALK_PAGE_SIZES = [20, 50, 100, 200]
+
 
 class OnSiteNamedModelForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
@@ -197,7 +199,8 @@ class TalkActionForm(forms.Form):
         site = kwargs.pop('site')
         talks = kwargs.pop('talks')
         super().__init__(*args, **kwargs)
-        self.fields['talks'].choices = [(talk.pk, None) for talk in talks.all()]
+        if self.is_bound:
+            self.fields['talks'].choices = [(pk, None) for pk in talks.values_list('pk', flat=True)]
         tracks = Track.objects.filter(site=site)
         self.fields['track'].choices = [(None, "---------")] + list(tracks.values_list('slug', 'name'))
         tags = Tag.objects.filter(site=site)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.core.cache import cache
+from django.contrib.sites.models import Site
+
+from cfp.planning import SCHEDULE_VERSION_KEY, evict_schedule
+from cfp.utils import CONFERENCE_VERSION_KEY, bump_conference_version
+
+
+class Command(BaseCommand):
+    help = 'Show the cache counters and the cached versions of each site, or flush the entries of some sites.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flush', type=int, action='append', default=[], metavar='SITE_ID',
+                            help='Flush the cache entries of the site (may be repeated)')
+
+    def handle(self, *args, **options):
+        if options['flush']:
+            for site_id in options['flush']:
+                # entries are looked up with the site versions, the old ones will be culled
+                evict_schedule(site_id)
+                bump_conference_version(site_id)
+                self.stdout.write(self.style.SUCCESS('Cache entries of site %d flushed.' % site_id))
+            return
+        if hasattr(cache, 'get_stats'):
+            stats = cache.get_stats()
+            for stat in ['local_hits', 'file_hits', 'misses']:
+                self.stdout.write('%s: %d' % (stat, stats.get(stat, 0)))
+        for site in Site.objects.order_by('pk'):
+            self.stdout.write('%d %s: schedule version %s, conference version %s' % (
+                site.pk, site.domain, cache.get(SCHEDULE_VERSION_KEY % site.pk), cache.get(CONFERENCE_VERSION_KEY % site.pk)))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from cfp.models import Talk
+
+
+class Command(BaseCommand):
+    help = 'Recompute the vote count, vote sum and score of every talk'
+
+    def handle(self, *args, **options):
+        count = Talk.objects.update_scores()
+        self.stdout.write(self.style.SUCCESS('%d talk(s) updated.' % count))
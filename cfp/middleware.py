@@ -1,6 +1,13 @@
 from django.contrib.sites.shortcuts import get_current_site
+from django.db import connections
+from django.template.base import Template
 
-from .models import Conference
+from contextlib import ExitStack
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from .utils import get_conference
 
 
 class ConferenceMiddleware:
@@ -12,5 +19,90 @@ class ConferenceMiddleware:
 
     def process_view(self, request, view, view_args, view_kwargs):
         site = get_current_site(request)
-        conf = Conference.objects.select_related('site').prefetch_related('staff').get(site=site)
-        request.conference = conf
+        request.conference = get_conference(site)
+
+
+# (url name, site pk) -> aggregated measures of the requests, for the current process
+_request_stats = {}
+_request_stats_lock = Lock()
+
+# [nesting level, duration] of the templates rendered by the current request
+_template_timer = ContextVar('template_timer', default=None)
+_template_render = Template.render
+
+
+def _timed_template_render(self, context):
+    timer = _template_timer.get()
+    if timer is None or timer[0]:
+        return _template_render(self, context)
+    timer[0] += 1
+    start = perf_counter()
+    try:
+        return _template_render(self, context)
+    finally:
+        timer[0] -= 1
+        timer[1] += perf_counter() - start
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += perf_counter() - start
+
+
+def get_request_stats(site_id):
+    with _request_stats_lock:
+        stats = [dict(stat, view=view) for (view, site), stat in _request_stats.items() if site == site_id]
+    for stat in stats:
+        for measure in ['queries', 'db_time', 'template_time', 'total_time', 'size']:
+            stat['avg_' + measure] = stat[measure] / stat['count']
+    return sorted(stats, key=lambda stat: stat['total_time'], reverse=True)
+
+
+class InstrumentationMiddleware:
+    """
+    Measure the SQL queries, template rendering time and response size of each request,
+    send them in a Server-Timing header, and aggregate them by url name and conference.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        Template.render = _timed_template_render
+
+    def __call__(self, request):
+        queries = QueryTimer()
+        templates = [0, 0]
+        token = _template_timer.set(templates)
+        start = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(queries))
+                response = self.get_response(request)
+        finally:
+            _template_timer.reset(token)
+        total = perf_counter() - start
+        size = 0 if response.streaming else len(response.content)
+        response['Server-Timing'] = 'db;dur=%.1f;desc="%d queries", tpl;dur=%.1f, total;dur=%.1f' % (
+            queries.duration * 1000, queries.count, templates[1] * 1000, total * 1000)
+        conference = getattr(request, 'conference', None)
+        if request.resolver_match and conference:
+            key = (request.resolver_match.view_name, conference.site_id)
+            with _request_stats_lock:
+                stats = _request_stats.setdefault(key, {'count': 0, 'queries': 0, 'max_queries': 0, 'db_time': 0,
+                                                        'template_time': 0, 'total_time': 0, 'size': 0})
+                stats['count'] += 1
+                stats['queries'] += queries.count
+                stats['max_queries'] = max(stats['max_queries'], queries.count)
+                stats['db_time'] += queries.duration
+                stats['template_time'] += templates[1]
+                stats['total_time'] += total
+                stats['size'] += size
+        return response
@@ -0,0 +1,43 @@
+# Generated by Django 3.1 on 2026-10-18 19:23
+
+from django.db import migrations, models
+from django.db.models import Count, Sum, Avg, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def forward(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Talk = apps.get_model("cfp", "Talk")
+    Vote = apps.get_model("cfp", "Vote")
+    votes = Vote.objects.using(db_alias).filter(talk=OuterRef('pk')).order_by().values('talk')
+    Talk.objects.using(db_alias).update(
+        vote_count=Coalesce(Subquery(votes.annotate(count=Count('pk')).values('count')), 0),
+        vote_sum=Coalesce(Subquery(votes.annotate(sum=Sum('vote')).values('sum')), 0),
+        score=Coalesce(Subquery(votes.annotate(avg=Avg('vote')).values('avg'), output_field=models.FloatField()), 0.0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cfp', '0027_auto_20200809_1530'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='talk',
+            name='score',
+            field=models.FloatField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='talk',
+            name='vote_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='talk',
+            name='vote_sum',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(forward, migrations.RunPython.noop),
+    ]
@@ -4,7 +4,7 @@ from django.urls import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import Q, Count, Avg, Case, When
+from django.db.models import Q, Count, Sum, Avg, Case, When, OuterRef, Subquery
 from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.translation import ugettext, ugettext_lazy as _
@@ -94,15 +94,13 @@ class Conference(models.Model):
         return self.name
 
 
-class ParticipantManager(models.Manager):
-    def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.annotate(
+class ParticipantQuerySet(models.QuerySet):
+    def with_talk_counts(self):
+        return self.annotate(
             accepted_talk_count=Count(Case(When(talk__accepted=True, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
             pending_talk_count=Count(Case(When(talk__accepted=None, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
             refused_talk_count=Count(Case(When(talk__accepted=False, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
         )
-        return qs
 
 
 class Participant(PonyConfModel):
@@ -124,7 +122,7 @@ class Participant(PonyConfModel):
     vip = models.BooleanField(default=False, verbose_name=_('Invited speaker'))
     conversation = models.OneToOneField(MessageThread, on_delete=models.PROTECT)
 
-    objects = ParticipantManager()
+    objects = ParticipantQuerySet.as_manager()
 
     def get_absolute_url(self):
         return reverse('participant-details', kwargs={'participant_id': self.pk})
@@ -308,11 +306,14 @@ class TalkCategory(models.Model): # type of talk (conf 30min, 1h, stand, …)
 #        return self.get_name()
 
 
-class TalkManager(models.Manager):
-    def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.annotate(score=Coalesce(Avg('vote__vote'), 0))
-        return qs
+class TalkQuerySet(models.QuerySet):
+    def update_scores(self):
+        votes = Vote.objects.filter(talk=OuterRef('pk')).order_by().values('talk')
+        return self.update(
+            vote_count=Coalesce(Subquery(votes.annotate(count=Count('pk')).values('count')), 0),
+            vote_sum=Coalesce(Subquery(votes.annotate(sum=Sum('vote')).values('sum')), 0),
+            score=Coalesce(Subquery(votes.annotate(avg=Avg('vote')).values('avg'), output_field=models.FloatField()), 0.0),
+        )
 
 
 def talks_materials_destination(talk, filename):
@@ -358,8 +359,13 @@ class Talk(PonyConfModel):
     video = models.URLField(max_length=1000, blank=True, default='', verbose_name='Video URL')
     token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     conversation = models.OneToOneField(MessageThread, on_delete=models.PROTECT)
+    vote_count = models.PositiveIntegerField(default=0, editable=False)
+    vote_sum = models.IntegerField(default=0, editable=False)
+    score = models.FloatField(default=0, editable=False, db_index=True)
+
+    objects = TalkQuerySet.as_manager()
 
-    objects = TalkManager()
+    SCORE_FIELDS = ('vote_count', 'vote_sum', 'score')
 
     class Meta:
         ordering = ('title',)
@@ -367,6 +373,14 @@ class Talk(PonyConfModel):
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # the scores are only written by update_scores(), a full save would overwrite the votes cast meanwhile
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            excluded = set(self.SCORE_FIELDS) | self.get_deferred_fields()
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.attname not in excluded and field.name not in excluded]
+        super().save(*args, **kwargs)
+
     def get_speakers_str(self):
         speakers = list(map(str, self.speakers.all()))
         if len(speakers) == 0:
@@ -1,6 +1,6 @@
-from django.db.models import Q, Prefetch
-from django.utils.safestring import mark_safe
+from django.db.models import Q, Prefetch, Max, Count
 from django.utils.html import escape
+from django.utils.crypto import get_random_string
 from django.utils.timezone import localtime, now
 from django.core.cache import cache
 from django.urls import reverse
@@ -10,16 +10,179 @@ from django.conf import settings
 from datetime import datetime, timedelta
 from copy import deepcopy
 from collections import OrderedDict, namedtuple
+from bisect import bisect_left
 from itertools import islice
 from zlib import adler32
+from hashlib import md5
+from uuid import uuid5, NAMESPACE_URL
+import json
 import xml.etree.ElementTree as ET
 from icalendar import Calendar as iCalendar, Event as iEvent
 
-from .models import Conference, Talk, Room, Tag
+from .models import Conference, Talk, Tag
 
 
 Event = namedtuple('Event', ['talk', 'row', 'rowcount'])
 
+# Compact and immutable records of the scheduled talks, built once per schedule version
+# and shared by all the renderers: dates are already converted and strings already computed.
+ConferenceRecord = namedtuple('ConferenceRecord', ['name', 'venue', 'city', 'videos_available'])
+RoomRecord = namedtuple('RoomRecord', ['pk', 'name', 'label', 'slug'])
+SpeakerRecord = namedtuple('SpeakerRecord', ['pk', 'name'])
+TagRecord = namedtuple('TagRecord', ['slug', 'name', 'label'])
+TalkRecord = namedtuple('TalkRecord', [
+    'pk', 'title', 'slug', 'description', 'start_date', 'end_date', 'local_start', 'day', 'estimated_duration',
+    'room', 'plenary', 'accepted', 'updated', 'color', 'category', 'track', 'speakers', 'speakers_str',
+    'public_tags', 'staff_tags', 'materials', 'video', 'videotaped', 'video_licence',
+])
+Snapshot = namedtuple('Snapshot', ['version', 'conference', 'talks'])
+
+
+def _tag_records(tags):
+    return tuple(TagRecord(slug=tag.slug, name=tag.name, label=str(tag.label)) for tag in tags)
+
+
+def make_talk_record(talk, rooms):
+    """Return the record of a talk fetched by Program._get_talks(), sharing the room records given by pk."""
+    room = rooms.get(talk.room_id)
+    if room is None:
+        room = rooms[talk.room_id] = RoomRecord(pk=talk.room.pk, name=talk.room.name, label=talk.room.label,
+                                                slug=talk.room.slug)
+    duration = talk.estimated_duration
+    local_start = localtime(talk.start_date)
+    return TalkRecord(
+        pk=talk.pk,
+        title=talk.title,
+        slug=talk.slug,
+        description=talk.description,
+        start_date=talk.start_date,
+        end_date=talk.start_date + timedelta(minutes=duration),
+        local_start=local_start,
+        day=local_start.date(),
+        estimated_duration=duration,
+        room=room,
+        plenary=talk.plenary,
+        accepted=talk.accepted,
+        updated=talk.updated,
+        color=talk.category.color,
+        category=talk.category.label,
+        track=str(talk.track) if talk.track else None,
+        speakers=tuple(SpeakerRecord(pk=speaker.pk, name=str(speaker)) for speaker in talk.speakers.all()),
+        speakers_str=talk.get_speakers_str(),
+        public_tags=_tag_records(talk.public_tags),
+        staff_tags=_tag_records(talk.staff_tags),
+        materials=talk.materials.url if talk.materials else '',
+        video=talk.video,
+        videotaped=talk.videotaped,
+        video_licence=talk.video_licence,
+    )
+
+
+SCHEDULE_VERSION_KEY = 'ponyconf-schedule-version-%d'
+
+# entries of outdated schedule versions are not reachable anymore, let them expire
+SCHEDULE_TIMEOUT = 24 * 3600
+FRAGMENT_TIMEOUT = 7 * 24 * 3600
+# to be increased with any change of the fragments markup, not to use the ones of the previous releases
+FRAGMENT_FORMAT = 1
+FRAGMENT_GENERATION_KEY = 'ponyconf-schedule-fragment-generation-%d'
+
+
+def generate_schedule_version():
+    return get_random_string(length=12)
+
+
+def get_schedule_version(site_id):
+    return cache.get_or_set(SCHEDULE_VERSION_KEY % site_id, generate_schedule_version, None)
+
+
+def bump_schedule_version(site_id):
+    cache.set(SCHEDULE_VERSION_KEY % site_id, generate_schedule_version(), None)
+
+
+def get_fragment_generation(site_id):
+    return cache.get_or_set(FRAGMENT_GENERATION_KEY % site_id, generate_schedule_version, None)
+
+
+def evict_schedule(site_id):
+    """Drop all the cached schedule entries of the site, the fragments kept across versions included."""
+    bump_schedule_version(site_id)
+    cache.set(FRAGMENT_GENERATION_KEY % site_id, generate_schedule_version(), None)
+
+
+class Grid:
+    """
+    Day / timeslot / room layout of the scheduled talks.
+
+    Timeslots are kept sorted with bisect as talks are added, and the layout
+    of each day is only computed when needed.
+    """
+
+    def __init__(self):
+        self.timeslots = {}  # day -> sorted list of timeslots
+        self.day_talks = {}  # day -> {talk pk: talk}
+        self.room_set = set()
+        self.layouts = {}  # day -> (rows, cols), dropped when the day changes
+
+    @property
+    def days(self):
+        return sorted(self.timeslots.keys())
+
+    @property
+    def rooms(self):
+        return sorted(self.room_set, key=lambda room: room.name)
+
+    def add_talk(self, talk):
+        day = talk.day
+        assert(day == localtime(talk.end_date).date()) # this is a current limitation
+        timeslots = self.timeslots.setdefault(day, [])
+        for timeslot in (talk.start_date, talk.end_date):
+            index = bisect_left(timeslots, timeslot)
+            if index == len(timeslots) or timeslots[index] != timeslot:
+                timeslots.insert(index, timeslot)
+        self.day_talks.setdefault(day, {})[talk.pk] = talk
+        self.room_set.add(talk.room)
+        self.layouts.pop(day, None)
+
+    def layout(self, day):
+        if day not in self.layouts:
+            self.layouts[day] = self._compute_layout(day)
+        return self.layouts[day]
+
+    def _compute_layout(self, day):
+        timeslots = self.timeslots[day]
+        rows = OrderedDict([(timeslot, {}) for timeslot in timeslots[:-1]])
+        cols = {}
+        # plenary talks are placed last so they get the remaining columns
+        talks = sorted(self.day_talks.get(day, {}).values(), key=lambda talk: (talk.plenary, talk.start_date, talk.pk))
+        for talk in talks:
+            room = talk.room
+            dt1 = bisect_left(timeslots, talk.start_date)
+            dt2 = bisect_left(timeslots, talk.end_date)
+            col = None
+            for row, timeslot in enumerate(islice(timeslots, dt1, dt2)):
+                events = rows[timeslot].setdefault(room, [])
+                if col is None:
+                    col = 0
+                    while col < len(events) and events[col]:
+                        col += 1
+                    cols[room] = max(cols.get(room, 1), col+1)
+                event = Event(talk=talk, row=row, rowcount=dt2-dt1)
+                while len(events) <= col:
+                    events.append(None)
+                events[col] = event
+        return rows, cols
+
+    def rows(self, day):
+        return self.layout(day)[0]
+
+    def cols(self):
+        cols = OrderedDict([(room, 1) for room in self.rooms])
+        for day in self.timeslots.keys():
+            for room, count in self.layout(day)[1].items():
+                cols[room] = max(cols[room], count)
+        return cols
+
 
 class Program:
     def __init__(self, site, pending=False, cache=None, staff=False):
@@ -32,9 +195,8 @@ class Program:
         self.staff = staff
         self.initialized = False
 
-    def _lazy_init(self):
-        self.conference = Conference.objects.get(site=self.site)
-        self.talks = Talk.objects.\
+    def _get_talks(self):
+        talks = Talk.objects.\
                             exclude(category__label__exact='').\
                             exclude(confirmed=False).\
                             filter(site=self.site, room__isnull=False, start_date__isnull=False).\
@@ -44,227 +206,309 @@ class Program:
                                 Prefetch('tags', queryset=Tag.objects.filter(public=True), to_attr='public_tags'),
                                 'category', 'speakers', 'track', 'tags', 'room',
                             )
-
         if self.pending:
-            self.talks = self.talks.exclude(accepted=False)
+            talks = talks.exclude(accepted=False)
         else:
-            self.talks = self.talks.filter(accepted=True)
-
-        self.talks = self.talks.order_by('start_date')
-
-        self.rooms = Room.objects.filter(talk__in=self.talks.all()).order_by('name').distinct()
-
-        self.days = {}
-        for talk in self.talks.all():
-            duration = talk.estimated_duration
-            assert(duration)
-            dt1 = talk.start_date
-            d1 = localtime(dt1).date()
-            if d1 not in self.days.keys():
-                self.days[d1] = {'timeslots': []}
-            dt2 = dt1 + timedelta(minutes=duration)
-            d2 = localtime(dt2).date()
-            if d2 not in self.days.keys():
-                self.days[d2] = {'timeslots': []}
-            if dt1 not in self.days[d1]['timeslots']:
-                self.days[d1]['timeslots'].append(dt1)
-            if dt2 not in self.days[d2]['timeslots']:
-                self.days[d2]['timeslots'].append(dt2)
-
-        self.cols = OrderedDict([(room, 1) for room in self.rooms])
-        for day in self.days.keys():
-            self.days[day]['timeslots'] = sorted(self.days[day]['timeslots'])
-            self.days[day]['rows'] = OrderedDict([(timeslot, OrderedDict([(room, []) for room in self.rooms])) for timeslot in self.days[day]['timeslots'][:-1]])
-
-        for talk in self.talks.exclude(plenary=True).all():
-            self._add_talk(talk)
-
-        for talk in self.talks.filter(plenary=True).all():
-            self._add_talk(talk)
+            talks = talks.filter(accepted=True)
+        return talks.order_by('start_date')
 
+    def _snapshot(self):
+        conference = Conference.objects.get(site=self.site)
+        rooms = {}
+        return Snapshot(
+            version=get_schedule_version(self.site.pk),
+            conference=ConferenceRecord(name=conference.name, venue=conference.venue, city=conference.city,
+                                        videos_available=bool(conference.videos_available)),
+            talks=tuple(make_talk_record(talk, rooms) for talk in self._get_talks()),
+        )
+
+    def snapshot(self):
+        """
+        Records of the conference and of its scheduled talks (sorted by start date), read by every renderer.
+        The snapshot is cached as long as the program is unchanged.
+        """
+        if not self.cache:
+            return self._snapshot()
+        cache_entry = self._cache_entry('snapshot')
+        snapshot = cache.get(cache_entry)
+        if snapshot is None:
+            snapshot = self._snapshot()
+            cache.set(cache_entry, snapshot, SCHEDULE_TIMEOUT)
+        return snapshot
+
+    def _lazy_init(self):
+        snapshot = self.snapshot()
+        self.version = snapshot.version
+        self.conference = snapshot.conference
+        self.talks = snapshot.talks
+        self.grid = Grid()
+        for talk in self.talks:
+            self.grid.add_talk(talk)
         self.initialized = True
 
-    def _add_talk(self, talk):
-        room = talk.room
-        dt1 = talk.start_date
-        d1 = localtime(dt1).date()
-        dt2 = talk.start_date + timedelta(minutes=talk.estimated_duration)
-        d2 = localtime(dt2).date()
-        assert(d1 == d2) # this is a current limitation
-        dt1 = self.days[d1]['timeslots'].index(dt1)
-        dt2 = self.days[d1]['timeslots'].index(dt2)
-        col = None
-        for row, timeslot in enumerate(islice(self.days[d1]['timeslots'], dt1, dt2)):
-            if col is None:
-                col = 0
-                while col < len(self.days[d1]['rows'][timeslot][room]) and self.days[d1]['rows'][timeslot][room][col]:
-                    col += 1
-                self.cols[room] = max(self.cols[room], col+1)
-            event = Event(talk=talk, row=row, rowcount=dt2-dt1)
-            while len(self.days[d1]['rows'][timeslot][room]) <= col:
-                self.days[d1]['rows'][timeslot][room].append(None)
-            self.days[d1]['rows'][timeslot][room][col] = event
-
-    def _html_header(self):
-        output = '<td>Room</td>'
-        room_cell = '<td%(options)s>%(name)s<br><b>%(label)s</b></td>'
-        for room, colspan in self.cols.items():
-            options = ' style="min-width: 100px;" colspan="%d"' % colspan
-            output += room_cell % {'name': escape(room.name), 'label': escape(room.label), 'options': options}
-        return '<tr>%s</tr>' % output
-
-    def _html_body(self):
-        output = ''
-        for day in sorted(self.days.keys()):
-            output += self._html_day_header(day)
-            output += self._html_day(day)
-        return output
-
-    def _html_day_header(self, day):
-        row = '<tr><td colspan="%(colcount)s"><h3>%(day)s</h3></td></tr>'
-        colcount = 1
-        for room, col in self.cols.items():
-            colcount += col
-        return row % {
-            'colcount': colcount,
-            'day': datetime.strftime(day, '%A %d %B'),
-        }
+    @property
+    def rooms(self):
+        return self.grid.rooms
+
+    @property
+    def days(self):
+        return self.grid.days
+
+    def _day_talks(self, day):
+        return sorted(self.grid.day_talks[day].values(), key=lambda talk: (talk.start_date, talk.pk))
+
+    def _fragment(self, key, talks, render):
+        """
+        Return render(), cached under a digest of the talk records shown by the fragment and of key.
+        The schedule version is not part of the digest: a change only renders again the fragments it affects.
+        They are all dropped by evict_schedule(), or by a new FRAGMENT_FORMAT.
+        """
+        if not self.cache:
+            return render()
+        if not hasattr(self, 'fragment_generation'):
+            self.fragment_generation = get_fragment_generation(self.site.pk)
+        digest = md5(repr((FRAGMENT_FORMAT, self.fragment_generation, key, self.site.domain, self.staff,
+                           self.conference.videos_available, talks)).encode('utf-8')).hexdigest()
+        cache_entry = 'ponyconf-schedule-fragment-%d-%s' % (self.site.pk, digest)
+        result = cache.get(cache_entry)
+        if result is None:
+            result = render()
+            cache.set(cache_entry, result, FRAGMENT_TIMEOUT)
+        return result
+
+    def _html_header(self, cols):
+        cells = ['<td>Room</td>']
+        for room, colspan in cols:
+            cells.append('<td style="min-width: 100px;" colspan="%d">%s<br><b>%s</b></td>'
+                         % (colspan, escape(room.name), escape(room.label)))
+        return '<tr>%s</tr>' % ''.join(cells)
 
-    def _html_day(self, day):
-        output = []
-        rows = self.days[day]['rows']
-        for ts, rooms in rows.items():
-            output.append(self._html_row(day, ts, rooms))
-        return '\n'.join(output)
-
-    def _html_row(self, day, ts, rooms):
-        row = '<tr style="%(style)s">%(timeslot)s%(content)s</tr>'
-        cell = '<td%(options)s>%(content)s</td>'
-        content = ''
-        for room, events in rooms.items():
+    def _html_day(self, day, cols, colcount):
+        timeslots = self.grid.timeslots[day]
+        times = [localtime(ts).strftime('%H:%M') for ts in timeslots]
+        rows = []
+        # rows are sorted by timeslot, so the row index gives the timeslot end
+        for index, room_events in enumerate(self.grid.rows(day).values()):
+            duration = (timeslots[index+1] - timeslots[index]).seconds / 60
+            rows.append('<tr style="height: %dpx;"><td>%s – %s</td>%s</tr>' % (
+                int(duration * 1.2), times[index], times[index+1], self._html_row(room_events, cols)))
+        header = '<tr><td colspan="%d"><h3>%s</h3></td></tr>' % (colcount, datetime.strftime(day, '%A %d %B'))
+        return header + '\n'.join(rows)
+
+    def _html_row(self, room_events, cols):
+        cells = []
+        for room, colcount in cols:
+            events = room_events.get(room, ())
             colspan = 1
-            for i in range(self.cols[room]):
-                options = ' colspan="%d"' % colspan
-                cellcontent = ''
+            for i in range(colcount):
                 if i < len(events) and events[i]:
                     event = events[i]
                     if event.row != 0:
                         continue
-                    options = ' rowspan="%d" bgcolor="%s"' % (event.rowcount, event.talk.category.color)
-                    options += ' id="%d"' % event.id
-                    cellcontent = escape(str(event.talk)) + '<br><em>' + escape(event.talk.get_speakers_str()) + '</em>'
-                    if self.staff:
-                        tags = event.talk.staff_tags
-                    else:
-                        tags = event.talk.public_tags
-                    for tag in tags:
-                        cellcontent += '<br>' + tag.label
-                elif (i+1 > len(events) or not events[i+1]) and i+1 < self.cols[room]:
+                    talk = event.talk
+                    tags = talk.staff_tags if self.staff else talk.public_tags
+                    cells.append('<td rowspan="%d" bgcolor="%s" id="%d">%s<br><em>%s</em>%s</td>' % (
+                        event.rowcount, talk.color, talk.pk, escape(talk.title), escape(talk.speakers_str),
+                        ''.join('<br>' + tag.label for tag in tags)))
+                elif (i+1 >= len(events) or not events[i+1]) and i+1 < colcount:
                     colspan += 1
                     continue
+                else:
+                    cells.append('<td colspan="%d"></td>' % colspan)
                 colspan = 1
-                content += cell % {'options': options, 'content': mark_safe(cellcontent)}
-        style, timeslot = self._html_timeslot(day, ts)
-        return row % {
-            'style': style,
-            'timeslot': timeslot,
-            'content': content,
-        }
+        return ''.join(cells)
 
-    def _html_timeslot(self, day, ts):
-        template = '<td>%(content)s</td>'
-        start = ts
-        end = self.days[day]['timeslots'][self.days[day]['timeslots'].index(ts)+1]
-        duration = (end - start).seconds / 60
-        date_to_string = lambda date: datetime.strftime(localtime(date), '%H:%M')
-        style = 'height: %dpx;' % int(duration * 1.2)
-        timeslot = '<td>%s – %s</td>' % tuple(map(date_to_string, [start, end]))
-        return style, timeslot
-
-    def _as_html(self):
-        template = """<table class="table table-bordered text-center">\n%(header)s\n%(body)s\n</table>"""
+    def _html_chunks(self):
+        """Render the program table day by day, in a single pass over the grid."""
         if not self.initialized:
             self._lazy_init()
-        return template % {
-            'header': self._html_header(),
-            'body': self._html_body(),
-        }
+        cols = list(self.grid.cols().items())
+        colcount = 1 + sum(colspan for room, colspan in cols)
+        yield '<table class="table table-bordered text-center">\n%s\n' % self._html_header(cols)
+        for day in self.days:
+            # the day layout depends on the columns of the whole program
+            yield self._fragment(('html', day, cols), self._day_talks(day),
+                                 lambda: self._html_day(day, cols, colcount))
+        yield '\n</table>'
 
-    def _as_xml(self):
-        if not self.initialized:
-            self._lazy_init()
-        schedule = ET.Element('schedule')
+    def _as_html(self):
+        return ''.join(self._html_chunks())
 
-        conference = ET.SubElement(schedule, 'conference')
+    def _xml_conference(self):
+        conference = ET.Element('conference')
         elt = ET.SubElement(conference, 'title')
         elt.text = self.conference.name
         elt = ET.SubElement(conference, 'venue')
         elt.text = ', '.join(map(lambda x: x.strip(), self.conference.venue.split('\n')))
         elt = ET.SubElement(conference, 'city')
         elt.text = self.conference.city
-        if self.days:
+        days = self.days
+        if days:
             elt = ET.SubElement(conference, 'start_date')
-            elt.text = sorted(self.days.keys())[0].strftime('%Y-%m-%d')
+            elt.text = days[0].strftime('%Y-%m-%d')
             elt = ET.SubElement(conference, 'end_date')
-            elt.text = sorted(self.days.keys(), reverse=True)[0].strftime('%Y-%m-%d')
+            elt.text = days[-1].strftime('%Y-%m-%d')
             elt = ET.SubElement(conference, 'days_count')
-            elt.text = str(len(self.days))
-
-        for index, day in enumerate(sorted(self.days.keys())):
-            day_elt = ET.SubElement(schedule, 'day', index=str(index+1), date=day.strftime('%Y-%m-%d'))
-            for room in self.rooms.all():
-                room_elt = ET.SubElement(day_elt, 'room', name=room.name)
-                for talk in self.talks.filter(room=room).order_by('start_date'):
-                    if localtime(talk.start_date).date() != day:
-                        continue
-                    talk_elt = ET.SubElement(day_elt, 'event', id=str(talk.id))
-                    duration = talk.estimated_duration
-                    persons_elt = ET.SubElement(talk_elt, 'persons')
-                    for speaker in talk.speakers.all():
-                        person_elt = ET.SubElement(talk_elt, 'person', id=str(speaker.id))
-                        person_elt.text = str(speaker)
-#                    #if talk.registration_required and self.conference.subscriptions_open:
-#                    #    links += mark_safe("""
-#                    #    <link tag="registration">%(link)s</link>""" % {
-#                    #        'link': reverse('register-for-a-talk', args=[talk.slug]),
-#                    #    })
-#                    #    registration = """
-#                    #  <attendees_max>%(max)s</attendees_max>
-#                    #  <attendees_remain>%(remain)s</attendees_remain>""" % {
-#                    #    'max': talk.attendees_limit,
-#                    #    'remain': talk.remaining_attendees or 0,
-#                    #  }
-                    tags_elt = ET.SubElement(talk_elt, 'tags')
-                    for tag in talk.tags.filter(public=True):
-                        tag_elt = ET.SubElement(tags_elt, 'tag', slug=str(tag.slug))
-                        tag_elt.text = tag.name
-                    elt = ET.SubElement(talk_elt, 'start')
-                    elt.text = localtime(talk.start_date).strftime('%H:%M')
-                    elt = ET.SubElement(talk_elt, 'duration')
-                    elt.text = '%02d:%02d' % (talk.estimated_duration / 60, talk.estimated_duration % 60)
-                    elt = ET.SubElement(talk_elt, 'room')
-                    elt.text = room.name
-                    elt = ET.SubElement(talk_elt, 'slug')
-                    elt.text = talk.slug
-                    elt = ET.SubElement(talk_elt, 'title')
-                    elt.text = talk.title
-                    elt = ET.SubElement(talk_elt, 'subtitle')
-                    elt = ET.SubElement(talk_elt, 'track')
-                    elt.text = str(talk.track) if talk.track else ''
-                    elt = ET.SubElement(talk_elt, 'type')
-                    elt.text = talk.category.label
-                    elt = ET.SubElement(talk_elt, 'language')
-                    elt = ET.SubElement(talk_elt, 'description')
-                    elt.text = talk.description
-                    links_elt = ET.SubElement(talk_elt, 'links')
-                    if talk.materials:
-                        elt = ET.SubElement(links_elt, 'link', tag='slides')
-                        elt.text = talk.materials.url
-                    if talk.video and self.conference.videos_available:
-                        elt = ET.SubElement(links_elt, 'link', tag='video')
-                        elt.text = talk.video
-
-        return ET.tostring(schedule)
+            elt.text = str(len(days))
+        return conference
+
+    def _xml_event(self, talk, videos_available):
+        room = talk.room
+        talk_elt = ET.Element('event', id=str(talk.pk))
+        persons_elt = ET.SubElement(talk_elt, 'persons')
+        for speaker in talk.speakers:
+            person_elt = ET.SubElement(talk_elt, 'person', id=str(speaker.pk))
+            person_elt.text = speaker.name
+#        #if talk.registration_required and self.conference.subscriptions_open:
+#        #    links += mark_safe("""
+#        #    <link tag="registration">%(link)s</link>""" % {
+#        #        'link': reverse('register-for-a-talk', args=[talk.slug]),
+#        #    })
+#        #    registration = """
+#        #  <attendees_max>%(max)s</attendees_max>
+#        #  <attendees_remain>%(remain)s</attendees_remain>""" % {
+#        #    'max': talk.attendees_limit,
+#        #    'remain': talk.remaining_attendees or 0,
+#        #  }
+        tags_elt = ET.SubElement(talk_elt, 'tags')
+        for tag in talk.public_tags:
+            tag_elt = ET.SubElement(tags_elt, 'tag', slug=str(tag.slug))
+            tag_elt.text = tag.name
+        duration = talk.estimated_duration
+        elt = ET.SubElement(talk_elt, 'start')
+        elt.text = talk.local_start.strftime('%H:%M')
+        elt = ET.SubElement(talk_elt, 'duration')
+        elt.text = '%02d:%02d' % (duration / 60, duration % 60)
+        elt = ET.SubElement(talk_elt, 'room')
+        elt.text = room.name
+        elt = ET.SubElement(talk_elt, 'slug')
+        elt.text = talk.slug
+        elt = ET.SubElement(talk_elt, 'title')
+        elt.text = talk.title
+        elt = ET.SubElement(talk_elt, 'subtitle')
+        elt = ET.SubElement(talk_elt, 'track')
+        elt.text = talk.track or ''
+        elt = ET.SubElement(talk_elt, 'type')
+        elt.text = talk.category
+        elt = ET.SubElement(talk_elt, 'language')
+        elt = ET.SubElement(talk_elt, 'description')
+        elt.text = talk.description
+        links_elt = ET.SubElement(talk_elt, 'links')
+        if talk.materials:
+            elt = ET.SubElement(links_elt, 'link', tag='slides')
+            elt.text = talk.materials
+        if talk.video and videos_available:
+            elt = ET.SubElement(links_elt, 'link', tag='video')
+            elt.text = talk.video
+        return talk_elt
+
+    def _xml_room(self, room, talks):
+        videos_available = self.conference.videos_available
+        elements = [ET.Element('room', name=room.name)]
+        elements += [self._xml_event(talk, videos_available) for talk in talks]
+        return b''.join(map(ET.tostring, elements))
+
+    def _xml_day(self, index, day, rooms):
+        # talks are grouped in memory from the already prefetched grid, no query per room or per talk
+        talks_by_room = {}
+        for talk in self._day_talks(day):
+            talks_by_room.setdefault(talk.room, []).append(talk)
+        chunks = [('<day index="%d" date="%s">' % (index+1, day.strftime('%Y-%m-%d'))).encode('ascii')]
+        for room in rooms:
+            talks = talks_by_room.get(room, [])
+            chunks.append(self._fragment(('xml', room), talks, lambda: self._xml_room(room, talks)))
+        chunks.append(b'</day>')
+        return b''.join(chunks)
+
+    def _xml_chunks(self):
+        """Serialize the schedule element by element so only one day is held as a tree at a time."""
+        if not self.initialized:
+            self._lazy_init()
+        rooms = self.rooms
+        yield b'<schedule>'
+        yield ET.tostring(self._xml_conference())
+        for index, day in enumerate(self.days):
+            yield self._xml_day(index, day, rooms)
+        yield b'</schedule>'
+
+    def _as_xml(self):
+        return b''.join(self._xml_chunks())
+
+    def _json_event(self, talk, videos_available):
+        duration = talk.estimated_duration
+        links = []
+        if talk.materials:
+            links.append({'url': talk.materials, 'title': 'slides'})
+        if talk.video and videos_available:
+            links.append({'url': talk.video, 'title': 'video'})
+        return {
+            'id': talk.pk,
+            'guid': str(uuid5(NAMESPACE_URL, '%s/%d' % (self.site.domain, talk.pk))),
+            'date': talk.local_start.isoformat(),
+            'start': talk.local_start.strftime('%H:%M'),
+            'duration': '%02d:%02d' % (duration / 60, duration % 60),
+            'room': talk.room.name,
+            'slug': talk.slug,
+            'title': talk.title,
+            'subtitle': '',
+            'track': talk.track,
+            'type': talk.category,
+            'language': None,
+            'abstract': '',
+            'description': talk.description,
+            'recording_license': talk.video_licence,
+            'do_not_record': not talk.videotaped,
+            'persons': [{'id': speaker.pk, 'public_name': speaker.name} for speaker in talk.speakers],
+            'links': links,
+            'attachments': [],
+        }
+
+    def _json_day(self, index, day):
+        videos_available = self.conference.videos_available
+        talks = self._day_talks(day)
+        rooms = OrderedDict((room.name, []) for room in self.rooms)
+        for talk in talks:
+            rooms[talk.room.name].append(self._json_event(talk, videos_available))
+        return {
+            'index': index,
+            'date': day.isoformat(),
+            'day_start': talks[0].local_start.isoformat(),
+            'day_end': localtime(max(talk.end_date for talk in talks)).isoformat(),
+            'rooms': rooms,
+        }
+
+    def _as_json(self, day=None, room=None):
+        """Return the program, or only a day (by index) or a room (by slug), None if there is no such day or room."""
+        if not self.initialized:
+            self._lazy_init()
+        all_days = self.days
+        rooms = self.rooms
+        if day is not None:
+            if not 1 <= day <= len(all_days):
+                return None
+            days = [(day, all_days[day-1])]
+        else:
+            days = [(index+1, d) for index, d in enumerate(all_days)]
+        if room is not None:
+            rooms = [r for r in rooms if r.slug == room]
+            if not rooms:
+                return None
+        json_days = []
+        for index, d in days:
+            json_day = self._fragment(('json', index, d, self.rooms), self._day_talks(d),
+                                      lambda: self._json_day(index, d))
+            json_days.append(dict(json_day, rooms=OrderedDict((r.name, json_day['rooms'][r.name]) for r in rooms)))
+        return json.dumps({'schedule': {
+            'version': self.version,
+            'conference': {
+                'acronym': self.site.domain,
+                'title': self.conference.name,
+                'start': all_days[0].isoformat() if all_days else None,
+                'end': all_days[-1].isoformat() if all_days else None,
+                'daysCount': len(all_days),
+                'days': json_days,
+            },
+        }})
 
     def _as_ics(self, citymeo=False):
         if not self.initialized:
@@ -276,35 +520,46 @@ class Program:
         cal.add('x-wr-timezone', settings.TIME_ZONE)
         cal.add('calscale', 'GREGORIAN')
         talks = self.talks
-        if citymeo and talks.exists():
-            talks = talks.filter(start_date__gte=now()-timedelta(minutes=5))
-            if talks.exists():
-                limit = talks.first().start_date.replace(hour=23, minute=59, second=59)
-                talks = talks.filter(start_date__lte=limit)
+        if citymeo and talks:
+            start = now() - timedelta(minutes=5)
+            talks = [talk for talk in talks if talk.start_date >= start]
+            if talks:
+                limit = talks[0].start_date.replace(hour=23, minute=59, second=59)
+                talks = [talk for talk in talks if talk.start_date <= limit]
         for talk in talks:
             event = iEvent()
             event.add('dtstart', talk.start_date)
-            if not talk.end_date:
-                continue
             event.add('dtend', talk.end_date)
             event.add('dtstamp', talk.updated)
             event.add('summary', talk.title)
-            if talk.room:
-                event.add('location', talk.room)
+            event.add('location', talk.room.name)
             event.add('status', 'CONFIRMED' if talk.accepted else 'TENTATIVE')
             if not citymeo:
                 event.add('description', talk.description)
-            event.add('uid', '%s/%s' % (self.site.domain, talk.id))
+            event.add('uid', '%s/%s' % (self.site.domain, talk.pk))
             cal.add_component(event)
         return cal.to_ical()
 
+    def get_etag(self, output='html', **kwargs):
+        """Cheap fingerprint of the rendered program, computed without rendering it."""
+        talks = Talk.objects.filter(site=self.site).aggregate(last_update=Max('updated'), count=Count('pk'))
+        return '%d-%s-%x' % (self.site.pk, get_schedule_version(self.site.pk), adler32('|'.join(map(str,
+            [output, self.pending, self.staff, self.site.conference.videos_available, talks['last_update'], talks['count']]
+            + list(kwargs.values()))).encode('utf-8')))
+
+    def _cache_entry(self, output, **kwargs):
+        return 'ponyconf-schedule-%d-%s-%d' % (self.site.pk, get_schedule_version(self.site.pk), adler32('|'.join(map(str,
+            [output, self.pending, self.staff, self.site.conference.videos_available] + list(kwargs.values()))).encode('utf-8')))
+
     def render(self, output='html', **kwargs):
         if self.cache:
-            cache_entry = 'ponyconf-%d' % adler32('|'.join(map(str, [self.site.domain, output, self.pending] + list(kwargs.values()))).encode('utf-8'))
+            # the site schedule version is bumped by signals each time something shown on the program changes,
+            # so entries are never stale, except when the output depends on the current time
+            cache_entry = self._cache_entry(output, **kwargs)
             result = cache.get(cache_entry)
             if not result:
                 result = getattr(self, '_as_%s' % output)(**kwargs)
-                cache.set(cache_entry, result, 3 * 60 * 60) # 3H
+                cache.set(cache_entry, result, 60 if kwargs.get('citymeo') else SCHEDULE_TIMEOUT)
             return result
         else:
             return getattr(self, '_as_%s' % output)(**kwargs)
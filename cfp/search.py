@@ -0,0 +1,102 @@
+from django.db import connections, DatabaseError
+from django.db.models import Q
+
+from functools import reduce
+import re
+
+from mailing.models import Message
+from .models import Participant, Talk
+
+
+# Indexed columns by model. With SQLite, the indexes are FTS5 tables kept up to date by triggers;
+# with PostgreSQL, they are GIN indexes on the tsvector of the columns. Other backends fall back
+# to case insensitive substring search.
+SEARCH_INDEX = {
+    Talk: ['title', 'description', 'notes'],
+    Participant: ['name', 'biography', 'email'],
+    Message: ['content'],
+}
+
+SEARCH_LIMIT = 50
+
+
+def _tsvector(connection, model, table=None):
+    qn = connection.ops.quote_name
+    columns = [qn(column) for column in SEARCH_INDEX[model]]
+    if table:
+        columns = ['%s.%s' % (qn(table), column) for column in columns]
+    columns = " || ' ' || ".join("coalesce(%s, '')" % column for column in columns)
+    return "to_tsvector('simple', %s)" % columns
+
+
+def _fts_table(model):
+    return '%s_fts' % model._meta.db_table
+
+
+def create_search_index(connection):
+    """Create the missing full-text indexes (and their triggers with SQLite)."""
+    qn = connection.ops.quote_name
+    if connection.vendor == 'sqlite':
+        tables = connection.introspection.table_names()
+        with connection.cursor() as cursor:
+            for model, columns in SEARCH_INDEX.items():
+                table, fts = model._meta.db_table, _fts_table(model)
+                values = ', '.join(columns)
+                new = ', '.join('new.%s' % column for column in columns)
+                old = ', '.join('old.%s' % column for column in columns)
+                if fts not in tables:
+                    try:
+                        cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content=%s, content_rowid='id')"
+                                       % (fts, values, qn(table)))
+                    except DatabaseError:
+                        # SQLite built without FTS5
+                        return
+                    cursor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts, fts))
+                # triggers are dropped when Django migrations rebuild the table, hence IF NOT EXISTS
+                cursor.execute("CREATE TRIGGER IF NOT EXISTS %s_insert AFTER INSERT ON %s BEGIN "
+                               "INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END" % (fts, qn(table), fts, values, new))
+                cursor.execute("CREATE TRIGGER IF NOT EXISTS %s_delete AFTER DELETE ON %s BEGIN "
+                               "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); END" % (fts, qn(table), fts, fts, values, old))
+                cursor.execute("CREATE TRIGGER IF NOT EXISTS %s_update AFTER UPDATE OF %s ON %s BEGIN "
+                               "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); "
+                               "INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END"
+                               % (fts, values, qn(table), fts, fts, values, old, fts, values, new))
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            for model in SEARCH_INDEX:
+                cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s USING GIN ((%s))"
+                               % (qn(_fts_table(model)), qn(model._meta.db_table), _tsvector(connection, model)))
+
+
+def search_filter(queryset, query):
+    """Filter the queryset on the words of query, the most relevant results first."""
+    words = re.findall(r'\w+', query)
+    if not words:
+        return queryset.none()
+    model = queryset.model
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    if connection.vendor == 'sqlite' and _fts_table(model) in connection.introspection.table_names():
+        fts = _fts_table(model)
+        return queryset.extra(
+            tables=[fts],
+            where=['%s.rowid = %s.id' % (fts, qn(model._meta.db_table)), '%s MATCH %%s' % fts],
+            params=[' '.join('"%s"*' % word for word in words)],
+            select={'search_rank': 'bm25(%s)' % fts},
+            order_by=['search_rank'],
+        )
+    elif connection.vendor == 'postgresql':
+        vector = _tsvector(connection, model, model._meta.db_table)
+        tsquery = ' & '.join('%s:*' % word for word in words)
+        return queryset.extra(
+            where=["%s @@ to_tsquery('simple', %%s)" % vector],
+            params=[tsquery],
+            select={'search_rank': "ts_rank(%s, to_tsquery('simple', %%s))" % vector},
+            select_params=[tsquery],
+            order_by=['-search_rank'],
+        )
+    else:
+        q = Q()
+        for word in words:
+            q &= reduce(lambda x, y: x | y, [Q(**{'%s__icontains' % column: word}) for column in SEARCH_INDEX[model]])
+        return queryset.filter(q).order_by('-pk')
@@ -1,7 +1,9 @@
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.db import connections, transaction
+from django.core.mail import get_connection
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 from django.urls import reverse
@@ -10,7 +12,10 @@ from django.contrib.auth import get_user_model
 from ponyconf.decorators import disable_for_loaddata
 from mailing.models import MessageThread, Message
 from mailing.utils import send_message
-from .models import Participant, Talk, Conference, Volunteer
+from .models import Participant, Talk, Conference, Volunteer, Room, Tag, TalkCategory, Track, Vote
+from .planning import bump_schedule_version
+from .utils import bump_conference_version
+from .search import create_search_index
 
 
 @receiver(post_save, sender=Site, dispatch_uid="Create Conference for Site")
@@ -29,7 +34,12 @@ pre_save.connect(create_conversation, sender=Volunteer)
 
 @receiver(post_save, sender=Message, dispatch_uid="Send message notifications")
 def send_message_notifications(sender, instance, **kwargs):
-    message = instance
+    notifications = get_message_notifications(instance)
+    if notifications:
+        get_connection().send_messages(notifications)
+
+
+def get_message_notifications(message):
     author = message.author.author
     thread = message.thread
     if message.in_reply_to:
@@ -52,7 +62,8 @@ def send_message_notifications(sender, instance, **kwargs):
     else:
         sender = str(author)
     sender = (sender, conf.contact_email)
-    staff_dests = [ (user, user.get_full_name(), user.email) for user in conf.staff.all() ]
+    get_staff_dests = lambda: [ (user, user.get_full_name(), user.email) for user in conf.staff.all() ]
+    notifications = []
     if hasattr(thread, 'participant') or hasattr(thread, 'volunteer'):
         if hasattr(thread, 'participant'):
             user = thread.participant
@@ -66,14 +77,76 @@ def send_message_notifications(sender, instance, **kwargs):
             user_subject = _('[%(conference)s] Message from the staff') % {'conference': str(conf)}
             staff_subject = _('[%(conference)s] Conversation with %(user)s') % {'conference': str(conf), 'user': str(user)}
         if author == user: # message from the user, notify the staff
-            message.send_notification(sender=sender, dests=staff_dests, reply_to=reply_to, message_id=message_id, reference=reference, subject=staff_subject)
+            notifications += message.get_notification(sender=sender, dests=get_staff_dests(), reply_to=reply_to, message_id=message_id, reference=reference, subject=staff_subject)
         else: # message to the user, notify the user, and the staff if the message is not a conference notification
-            message.send_notification(sender=sender, dests=dests, reply_to=reply_to, message_id=message_id, reference=reference, subject=user_subject)
+            notifications += message.get_notification(sender=sender, dests=dests, reply_to=reply_to, message_id=message_id, reference=reference, subject=user_subject)
             if author != conf:
-                message.send_notification(sender=sender, dests=staff_dests, reply_to=reply_to, message_id=message_id, reference=reference, subject=staff_subject)
+                notifications += message.get_notification(sender=sender, dests=get_staff_dests(), reply_to=reply_to, message_id=message_id, reference=reference, subject=staff_subject)
     elif hasattr(thread, 'talk'):
-        message.send_notification(sender=sender, dests=staff_dests,
-                                  reply_to=reply_to, message_id=message_id, reference=reference)
+        notifications += message.get_notification(sender=sender, dests=get_staff_dests(),
+                                                  reply_to=reply_to, message_id=message_id, reference=reference)
+    return notifications
+
+
+def invalidate_schedule(sender, instance, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        # a schedule rebuilt before the commit would be cached under the new version
+        site_id = instance.site_id
+        transaction.on_commit(lambda: bump_schedule_version(site_id))
+
+
+for model in [Talk, Room, Tag, TalkCategory, Track, Conference, Participant]:
+    post_save.connect(invalidate_schedule, sender=model)
+    post_delete.connect(invalidate_schedule, sender=model)
+m2m_changed.connect(invalidate_schedule, sender=Talk.tags.through)
+m2m_changed.connect(invalidate_schedule, sender=Talk.speakers.through)
+
+
+# the versions are bumped once committed, or a concurrent request could cache
+# the conference as it was before the change under the new version
+def bump_conference_versions(site_ids):
+    for site_id in site_ids:
+        bump_conference_version(site_id)
+
+
+@receiver(post_save, sender=Conference, dispatch_uid="Invalidate conference on save")
+def invalidate_conference(sender, instance, **kwargs):
+    site_id = instance.site_id
+    transaction.on_commit(lambda: bump_conference_version(site_id))
+
+
+@receiver(post_save, sender=Site, dispatch_uid="Invalidate conference on site save")
+@receiver(post_delete, sender=Site, dispatch_uid="Invalidate conference on site delete")
+def invalidate_site_conference(sender, instance, **kwargs):
+    site_id = instance.pk
+    transaction.on_commit(lambda: bump_conference_version(site_id))
+
+
+@receiver(m2m_changed, sender=Conference.staff.through, dispatch_uid="Invalidate conference on staff change")
+def invalidate_conference_staff(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        site_ids = [instance.site_id]
+    else:
+        conferences = Conference.objects.all()
+        if pk_set is not None:
+            conferences = conferences.filter(pk__in=pk_set)
+        site_ids = list(conferences.values_list('site_id', flat=True))
+    transaction.on_commit(lambda: bump_conference_versions(site_ids))
+
+
+@receiver(pre_delete, sender=User, dispatch_uid="Invalidate conference on staff member delete")
+def invalidate_staff_member_conference(sender, instance, **kwargs):
+    # the staff relations are removed without m2m_changed signal
+    site_ids = list(Conference.objects.filter(staff=instance).values_list('site_id', flat=True))
+    transaction.on_commit(lambda: bump_conference_versions(site_ids))
+
+
+@receiver(post_save, sender=Vote, dispatch_uid="Update talk score on vote save")
+@receiver(post_delete, sender=Vote, dispatch_uid="Update talk score on vote delete")
+def update_talk_score(sender, instance, **kwargs):
+    Talk.objects.filter(pk=instance.talk_id).update_scores()
 
 
 # connected in apps.py
@@ -84,3 +157,7 @@ def call_first_site_post_save(apps, **kwargs):
         pass
     else:
         site.save()
+
+
+def setup_search_index(using, **kwargs):
+    create_search_index(connections[using])
@@ -1,17 +1,48 @@
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.utils import timezone
 from django.contrib import messages
+from django.core import mail
 
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from unittest import mock
 from xml.etree import ElementTree as ET
 from icalendar import Calendar
 import pytz
-
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import shutil
+import tempfile
+
+from ponyconf.cache import TieredCache
+from mailing.models import Message, MessageAuthor
 from .models import *
 from .forms import VolunteerForm
+from .planning import Program
+from .search import search_filter
+from .utils import get_conference
+
+
+@contextmanager
+def run_on_commit():
+    """Run the on_commit callbacks registered in the block, as TestCase transactions are never committed."""
+    start = len(connection.run_on_commit)
+    yield
+    callbacks = connection.run_on_commit[start:]
+    del connection.run_on_commit[start:]
+    for sids, func in callbacks:
+        func()
 
 
 class VolunteersTests(TestCase):
@@ -46,7 +77,8 @@ class VolunteersTests(TestCase):
         self.assertEqual(self.client.get(reverse('volunteer-enrole')).status_code, 403)
         conf = Conference.objects.first()
         conf.volunteers_opening_date = timezone.now() - timedelta(hours=1)
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertEqual(self.client.get(reverse('volunteer-enrole')).status_code, 200)
         n = Volunteer.objects.count()
         response = self.client.post(reverse('volunteer-enrole'), {'name': 'B', 'email': 'b@example.org'})
@@ -62,7 +94,8 @@ class VolunteersTests(TestCase):
         self.assertEqual(self.client.get(reverse('volunteer-enrole')).status_code, 403)
         conf = Conference.objects.first()
         conf.volunteers_opening_date = timezone.now() - timedelta(hours=1)
-        conf.save()
+        with run_on_commit():
+            conf.save()
         user = User.objects.get(username='b')
         user.first_name = 'Jean'
         user.last_name = 'Mi'
@@ -146,7 +179,8 @@ class ProposalTest(TestCase):
         site = Site.objects.first()
         conf = Conference.objects.get(site=site)
         conf.home = '**Welcome!**'
-        conf.save()
+        with run_on_commit():
+            conf.save()
         response = self.client.get(reverse('home'))
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, '<strong>Welcome!</strong>')
@@ -330,7 +364,8 @@ class ProposalTest(TestCase):
         confirm_url = reverse('proposal-talk-confirm', kwargs={'speaker_token': speaker1.token, 'talk_id': talk.pk})
         desist_url = reverse('proposal-talk-desist', kwargs={'speaker_token': speaker1.token, 'talk_id': talk.pk})
         conf.acceptances_disclosure_date = timezone.now() - timedelta(hours=1)
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertTrue(conf.disclosed_acceptances)
         talk.accepted = None
         talk.save()
@@ -342,7 +377,8 @@ class ProposalTest(TestCase):
             self.assertEqual(self.client.get(url).status_code, 403)
         talk.accepted = True
         talk.save()
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertRedirects(self.client.get(confirm_url), talk_url)
         self.assertRedirects(self.client.get(confirm_url), talk_url)
         talk = Talk.objects.get(pk=talk.pk)
@@ -352,7 +388,8 @@ class ProposalTest(TestCase):
         talk = Talk.objects.get(pk=talk.pk)
         self.assertFalse(talk.confirmed)
         conf.acceptances_disclosure_date = timezone.now() + timedelta(hours=1)
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertFalse(conf.disclosed_acceptances)
         talk.confirmed = None
         talk.save()
@@ -469,8 +506,21 @@ class StaffTest(TestCase):
         response = self.client.get(url + '?format=csv')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-Disposition'), 'attachment; filename="participants.csv"')
-        self.assertContains(response, 'Speaker 1')
-        self.assertContains(response, 'Speaker 2')
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('Speaker 1', content)
+        self.assertIn('Speaker 2', content)
+
+    def test_speaker_talk_counts(self):
+        Talk.objects.filter(title='Talk 1').update(accepted=True)
+        speaker = Participant.objects.with_talk_counts().get(name='Speaker 1')
+        self.assertEqual((speaker.accepted_talk_count, speaker.pending_talk_count, speaker.refused_talk_count), (1, 0, 0))
+        with CaptureQueriesContext(connection) as queries:
+            Participant.objects.get(token=speaker.token)
+        self.assertNotIn('GROUP BY', queries[0]['sql'])
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('participant-list') + '?accepted=accepted')
+        self.assertEqual(len(response.context['participant_list']), 2)
+        self.assertContains(response, 'accepted: 1')
 
     def test_speaker_details(self):
         speaker1 = Participant.objects.get(name='Speaker 1')
@@ -522,6 +572,82 @@ class StaffTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-Disposition'), 'attachment; filename="talks.csv"')
 
+    def test_talk_list_pagination(self):
+        talk = Talk.objects.get(title='Talk 1')
+        for i in range(3, 46):
+            Talk.objects.create(site=talk.site, category=talk.category, title='Talk %d' % i, description='Talk', score=i % 5)
+        expected = list(Talk.objects.order_by('-score', '-pk').values_list('pk', flat=True))
+        url = reverse('talk-list')
+        self.client.login(username='admin', password='admin')
+        query = 'sort=score&order=desc&page_size=20'
+        pages = []
+        while query:
+            response = self.client.get(url + '?' + query)
+            self.assertEqual(response.context['talk_count'], 45)
+            pages.append([talk.pk for talk in response.context['talk_list']])
+            query = response.context['page_urls'].get('after')
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        self.assertEqual(sum(pages, []), expected)
+        response = self.client.get(url + '?' + response.context['page_urls']['before'])
+        self.assertEqual([talk.pk for talk in response.context['talk_list']], pages[1])
+        response = self.client.get(url + '?' + response.context['page_urls']['before'])
+        self.assertEqual([talk.pk for talk in response.context['talk_list']], pages[0])
+        self.assertNotIn('before', response.context['page_urls'])
+
+    def test_talk_list_action(self):
+        site = Site.objects.first()
+        track = Track.objects.create(site=site, name='Track')
+        tag = Tag.objects.create(site=site, name='Tag')
+        talks = Talk.objects.order_by('pk')
+        talks[0].tags.add(tag)
+        self.client.login(username='admin', password='admin')
+        messages_count = Message.objects.count()
+        with run_on_commit():
+            response = self.client.post(reverse('talk-list'), {
+                'talks': [talk.pk for talk in talks],
+                'decision': 'true',
+                'track': track.slug,
+                'tag': tag.slug,
+            })
+            # the notifications wait for the commit
+            self.assertEqual(Message.objects.count(), messages_count)
+        self.assertRedirects(response, reverse('talk-list'))
+        self.assertEqual(list(talks.values_list('accepted', 'track', 'room')), [(True, track.pk, None)] * 2)
+        self.assertEqual(Talk.objects.filter(tags=tag).count(), 2)
+        self.assertEqual(Message.objects.count(), messages_count + 2)
+        self.assertEqual(Message.objects.last().content, 'The talk has been accepted.')
+
+    @override_settings(EMAIL_BACKEND='mailing.tests.FailingBackend')
+    def test_talk_list_action_mail_failure(self):
+        site = Site.objects.first()
+        track = Track.objects.create(site=site, name='Track')
+        talks = Talk.objects.order_by('pk')
+        self.client.login(username='admin', password='admin')
+        # no notification, no connection to the mail server
+        with mock.patch('cfp.actions.send_bulk_messages') as send:
+            with run_on_commit():
+                self.client.post(reverse('talk-list'), {'talks': [talk.pk for talk in talks], 'track': track.slug})
+        send.assert_not_called()
+        # the committed decisions stay, the mail server failure is only logged
+        with self.assertLogs(level='ERROR'):
+            with run_on_commit():
+                response = self.client.post(reverse('talk-list'), {'talks': [talk.pk for talk in talks], 'decision': 'true'})
+        self.assertRedirects(response, reverse('talk-list'))
+        self.assertEqual(list(talks.values_list('accepted', flat=True)), [True, True])
+
+    def test_talk_list_csv(self):
+        talk = Talk.objects.get(title='Talk 1')
+        talk.tags.add(Tag.objects.create(site=talk.site, name='Tag 1'))
+        talk.speakers.add(Participant.objects.get(name='Speaker 2'))
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('talk-list') + '?format=csv')
+        with self.assertNumQueries(3):
+            content = b''.join(response.streaming_content).decode()
+        expected = []
+        for talk in Talk.objects.filter(site=talk.site).order_by('pk'):
+            expected.append(['' if value is None else str(value) for value in talk.get_csv_row()])
+        self.assertEqual(list(csv.reader(io.StringIO(content))), expected)
+
     def test_talk_details(self):
         talk = Talk.objects.get(title='Talk 1')
         url = reverse('talk-details', kwargs=dict(talk_id=talk.pk))
@@ -531,6 +657,95 @@ class StaffTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, talk.title)
 
+    def test_talk_details_messages(self):
+        talk = Talk.objects.get(title='Talk 1')
+        author = MessageAuthor.objects.get_or_create_for([User.objects.get(username='admin')]).popitem()[1]
+        Message.objects.bulk_create([Message(thread=talk.conversation, author=author, content='Message %d' % i) for i in range(25)])
+        url = reverse('talk-details', kwargs=dict(talk_id=talk.pk))
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(url)
+        self.assertEqual([m.content for m in response.context['conversation']], ['Message %d' % i for i in range(5, 25)])
+        self.assertContains(response, 'load-older-messages')
+        response = self.client.get(url, {'before': response.context['older_messages']}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertTemplateUsed(response, 'mailing/_message_list.html')
+        self.assertTemplateNotUsed(response, 'cfp/staff/talk_details.html')
+        self.assertEqual([m.content for m in response.context['messages']], ['Message %d' % i for i in range(5)])
+        self.assertNotContains(response, 'load-older-messages')
+
+    def test_talk_email(self):
+        talks = Talk.objects.order_by('pk')
+        self.client.login(username='admin', password='admin')
+        session = self.client.session
+        session['talk-email-list'] = list(talks.values_list('pk', flat=True))
+        session.save()
+        messages_count = Message.objects.count()
+        response = self.client.post(reverse('talk-email'), {
+            'subject': '{{ talk.title }}',
+            'body': 'Hello {{ speaker.name }}, speakers: {{ talk.speakers|map(attribute="name")|join(", ") }}',
+            'confirm': 'on',
+        })
+        self.assertRedirects(response, reverse('talk-list'))
+        self.assertEqual(Message.objects.count(), messages_count + 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual([(m.subject, m.body) for m in mail.outbox], [
+            ('Talk 1', 'Hello Speaker 1, speakers: Speaker 1, Speaker 2'),
+            ('Talk 1', 'Hello Speaker 2, speakers: Speaker 1, Speaker 2'),
+            ('Talk 2', 'Hello Speaker 3, speakers: Speaker 3'),
+        ])
+        self.assertEqual(mail.outbox[2].to, ['Speaker 3 <3@example.org>'])
+        thread = Participant.objects.get(name='Speaker 3').conversation
+        self.assertEqual(thread.message_set.get().content, 'Hello Speaker 3, speakers: Speaker 3')
+
+    def test_talk_vote(self):
+        talk = Talk.objects.get(title='Talk 1')
+        self.client.login(username='admin', password='admin')
+        self.assertRedirects(self.client.get(reverse('talk-vote', kwargs=dict(talk_id=talk.pk, score=2))), talk.get_absolute_url())
+        Vote.objects.create(talk=talk, user=User.objects.get(username='user1'), vote=-1)
+        talk.refresh_from_db()
+        self.assertEqual((talk.vote_count, talk.vote_sum, talk.score), (2, 1, 0.5))
+        self.assertRedirects(self.client.get(reverse('talk-vote', kwargs=dict(talk_id=talk.pk, score=1))), talk.get_absolute_url())
+        talk.refresh_from_db()
+        self.assertEqual((talk.vote_count, talk.vote_sum, talk.score), (2, 0, 0))
+        Vote.objects.filter(talk=talk).delete()
+        talk.refresh_from_db()
+        self.assertEqual((talk.vote_count, talk.vote_sum, talk.score), (0, 0, 0))
+        # a talk loaded before a vote does not erase it when saved
+        Vote.objects.create(talk=talk, user=User.objects.get(username='user1'), vote=2)
+        talk.title = 'Talk 1 renamed'
+        talk.save()
+        talk.refresh_from_db()
+        self.assertEqual((talk.title, talk.vote_count, talk.score), ('Talk 1 renamed', 1, 2))
+
+    def test_search(self):
+        talk1, talk2 = Talk.objects.get(title='Talk 1'), Talk.objects.get(title='Talk 2')
+        talk2.description = 'Ponies and unicorns'
+        talk2.save()
+        author = MessageAuthor.objects.get_or_create_for([User.objects.get(username='admin')]).popitem()[1]
+        Message.objects.create(thread=talk1.conversation, author=author, content='Is there any unicorn?')
+        url = reverse('search')
+        self.assertRedirects(self.client.get(url), reverse('login') + '?next=' + url)
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(url, {'q': 'UNICORN'})
+        self.assertEqual(list(response.context['talks']), [talk2])
+        self.assertEqual([m.thread for m in response.context['conversation']], [talk1.conversation])
+        self.assertContains(response, talk1.get_absolute_url())
+        response = self.client.get(url, {'q': '3@example.org'})
+        self.assertEqual([p.name for p in response.context['participants']], ['Speaker 3'])
+        self.assertEqual(list(search_filter(Talk.objects.all(), 'talk 1st')), [talk1])
+        talk2.delete()
+        self.assertEqual(list(search_filter(Talk.objects.all(), 'unicorns')), [])
+
+    @override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['cfp.middleware.InstrumentationMiddleware'])
+    def test_request_stats(self):
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('talk-list'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+, total;dur=[\d.]+$')
+        stats = {stat['view']: stat for stat in self.client.get(reverse('request-stats')).json()['views']}
+        self.assertGreaterEqual(stats['talk-list']['count'], 1)
+        self.assertGreater(stats['talk-list']['max_queries'], 0)
+        self.assertGreater(stats['talk-list']['template_time'], 0)
+        self.assertGreater(stats['talk-list']['size'], 0)
+
     def test_conference(self):
         conf = Conference.objects.get(name='PonyConf')
         url = reverse('conference-edit')
@@ -539,6 +754,27 @@ class StaffTest(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def test_conference_cache(self):
+        site = Site.objects.get_current()
+        conf = get_conference(site)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_conference(site).name, 'PonyConf')
+        conf.name = 'PonyConf 2'
+        with run_on_commit():
+            conf.save()
+        self.assertEqual(get_conference(site).name, 'PonyConf 2')
+        user = User.objects.get(username='user1')
+        self.client.login(username='user1', password='1')
+        self.assertEqual(self.client.get(reverse('staff')).status_code, 403)
+        with run_on_commit():
+            conf.staff.add(user)
+        self.assertEqual(self.client.get(reverse('staff')).status_code, 200)
+        with run_on_commit():
+            user.conference_set.clear()
+            # the conference version is bumped on commit, not to cache the staff as it was before
+            self.assertEqual(self.client.get(reverse('staff')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('staff')).status_code, 403)
+
     def test_conference_opened_categories(self):
         # TODO cover all cases
         conf = Conference.objects.get(name='PonyConf')
@@ -592,20 +828,24 @@ class StaffTest(TestCase):
         talk.duration = 60
         talk.accepted = True
         talk.video = 'this-is-a-video-location'
-        talk.save()
+        with run_on_commit():
+            talk.save()
         xml_url = reverse('public-schedule') + 'xml/'
         conf.schedule_publishing_date = now - timedelta(hours=1)
         conf.video_publishing_date = None
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertContains(self.client.get(xml_url), 'Talk 1')
         self.assertFalse(conf.videos_available)
         self.assertNotContains(self.client.get(xml_url), talk.video)
         conf.video_publishing_date = now + timedelta(hours=2)
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertFalse(conf.videos_available)
         self.assertNotContains(self.client.get(xml_url), talk.video)
         conf.video_publishing_date = now - timedelta(hours=1)
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertTrue(conf.videos_available)
         self.assertContains(self.client.get(xml_url), talk.video)
 
@@ -722,10 +962,12 @@ class ScheduleTest(TestCase):
         conf = Conference.objects.get(site=site)
         self.assertEqual(self.client.get(reverse('public-schedule')).status_code, 403)
         conf.schedule_publishing_date = timezone.now() - timedelta(hours=1)
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertEqual(self.client.get(reverse('public-schedule')).status_code, 200)
         conf.schedule_redirection_url ='http://example.net/schedule.html'
-        conf.save()
+        with run_on_commit():
+            conf.save()
         self.assertRedirects(self.client.get(reverse('public-schedule')), conf.schedule_redirection_url, status_code=302, fetch_redirect_response=False)
 
     def test_staff_schedule(self):
@@ -741,6 +983,44 @@ class ScheduleTest(TestCase):
         self.assertNotContains(response, 'Private tag')
         ET.fromstring(response.content)
 
+    def test_xml_queries(self):
+        site = Site.objects.first()
+        with CaptureQueriesContext(connection) as queries:
+            Program(site=site, cache=False).render('xml')
+        talk = Talk.objects.get(accepted=True)
+        for i in range(3):
+            room = Room.objects.create(site=site, name='Room %d' % (i + 2))
+            other = Talk.objects.create(site=site, title='Other %d' % i, description='Another talk.', category=talk.category,
+                                        room=room, start_date=talk.start_date + timedelta(days=i), duration=30, accepted=True)
+            other.speakers.add(*talk.speakers.all())
+        self.assertNumQueries(len(queries), Program(site=site, cache=False).render, 'xml')
+
+    def test_json(self):
+        site = Site.objects.first()
+        conf = Conference.objects.get(site=site)
+        conf.schedule_publishing_date = timezone.now() - timedelta(hours=1)
+        conf.save()
+        room = Room.objects.create(site=site, name='Room 2')
+        response = self.client.get(reverse('public-schedule') + 'json/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        schedule = response.json()['schedule']
+        self.assertEqual(schedule['conference']['daysCount'], 1)
+        day = schedule['conference']['days'][0]
+        self.assertEqual((day['index'], day['date']), (1, '2000-01-01'))
+        event = day['rooms']['Room 1'][0]
+        self.assertEqual((event['title'], event['room'], event['duration']), ('Talk', 'Room 1', '01:00'))
+        self.assertEqual([person['public_name'] for person in event['persons']], ['Participant 1'])
+        self.assertEqual(self.client.get(reverse('public-schedule-day', kwargs={'day': 1})).json(), response.json())
+        site.conference
+        with self.assertNumQueries(0):
+            # cut from the cached snapshot
+            self.assertIsNotNone(Program(site=site).render('json', day=1, room='room-1'))
+        response = self.client.get(reverse('public-schedule-room', kwargs={'room': 'room-1'}))
+        self.assertEqual(list(response.json()['schedule']['conference']['days'][0]['rooms']), ['Room 1'])
+        self.assertEqual(self.client.get(reverse('public-schedule-day', kwargs={'day': 2})).status_code, 404)
+        self.assertEqual(self.client.get(reverse('public-schedule-room', kwargs={'room': room.slug})).status_code, 404)
+        self.assertEqual(self.client.get(reverse('public-schedule-room', kwargs={'room': 'inexistent'})).status_code, 404)
+
     def test_ics(self):
         self.client.login(username='admin', password='admin')
         response = self.client.get(reverse('staff-schedule') + 'ics/')
@@ -754,6 +1034,146 @@ class ScheduleTest(TestCase):
         self.assertNotContains(response, 'Not staff tag')
         self.assertEqual(response.status_code, 200)
 
+    def test_snapshot(self):
+        site = Site.objects.select_related('conference').first()
+        Program(site=site, cache=True).snapshot()
+        # every format is rendered from the cached snapshot without any query
+        with self.assertNumQueries(0):
+            for output in ['html', 'xml', 'json', 'ics']:
+                self.assertTrue(getattr(Program(site=site, cache=True), '_as_%s' % output)())
+        talk = Talk.objects.get(accepted=True)
+        with run_on_commit():
+            talk.title = 'Renamed talk'
+            talk.save()
+        self.assertIn('Renamed talk', Program(site=site, cache=True)._as_html())
+
+    def test_fragment_cache(self):
+        site = Site.objects.first()
+        talk = Talk.objects.get(accepted=True)
+        other_talk = Talk.objects.create(site=site, title='Other talk', description='Another talk.', category=talk.category,
+                                         room=talk.room, start_date=talk.start_date + timedelta(days=1), duration=30, accepted=True)
+        for output in ['html', 'xml', 'json']:
+            Program(site=site, cache=True).render(output)
+        with run_on_commit():
+            other_talk.title = 'Renamed talk'
+            other_talk.save()
+        calls = []
+        def spy(method):
+            def wrapper(program, *args):
+                calls.append((method.__name__,) + args)
+                return method(program, *args)
+            return wrapper
+        with mock.patch.object(Program, '_html_day', spy(Program._html_day)), \
+             mock.patch.object(Program, '_xml_room', spy(Program._xml_room)), \
+             mock.patch.object(Program, '_json_day', spy(Program._json_day)):
+            results = [Program(site=site, cache=True).render(output) for output in ['html', 'xml', 'json']]
+        self.assertEqual(results, [Program(site=site, cache=False).render(output) for output in ['html', 'xml', 'json']])
+        self.assertIn('Renamed talk', results[0])
+        # only the fragments of the second day are rendered again
+        day = timezone.localtime(other_talk.start_date).date()
+        self.assertEqual([call[0] for call in calls], ['_html_day', '_xml_room', '_json_day'])
+        self.assertEqual(calls[0][1], day)
+        self.assertEqual(calls[2][1:], (2, day))
+
+    def test_schedule_evict(self):
+        site = Site.objects.first()
+        Program(site=site, cache=True).render('html')
+        self.client.login(username='admin', password='admin')
+        self.client.get(reverse('schedule-evict'))
+        with mock.patch.object(Program, '_html_day', side_effect=Program._html_day, autospec=True) as html_day:
+            Program(site=site, cache=True).render('html')
+        # the fragments are rendered again
+        self.assertEqual(html_day.call_count, 1)
+
+    def test_grid(self):
+        site = Site.objects.first()
+        talk = Talk.objects.get(accepted=True)
+        other_room = Room.objects.create(site=site, name='Room 2')
+        Talk.objects.create(site=site, title='Other talk', description='Another talk.', category=talk.category,
+                            room=other_room, start_date=talk.start_date + timedelta(days=1), duration=30, accepted=True)
+        program = Program(site=site, cache=False)
+        program.render('html')
+        self.assertEqual([room.name for room in program.rooms], ['Room 1', 'Room 2'])
+        self.assertEqual(len(program.days), 2)
+        self.assertEqual([len(program.grid.timeslots[day]) for day in program.days], [2, 2])
+
+    def test_cache_invalidation(self):
+        site = Site.objects.first()
+        talk = Talk.objects.get(accepted=True)
+        self.assertIn(b'<title>Talk</title>', Program(site=site, cache=True).render('xml'))
+        with self.assertNumQueries(0):
+            Program(site=site, cache=True).render('xml')
+        with run_on_commit():
+            talk.title = 'Renamed talk'
+            talk.save()
+            # the schedule version is bumped on commit, not to cache a schedule of uncommitted changes
+            self.assertIn(b'<title>Talk</title>', Program(site=site, cache=True).render('xml'))
+        self.assertIn(b'<title>Renamed talk</title>', Program(site=site, cache=True).render('xml'))
+        with run_on_commit():
+            Tag.objects.filter(name='Public tag').get().talk_set.remove(talk)
+        self.assertNotIn(b'Public tag', Program(site=site, cache=True).render('xml'))
+
+    def test_conditional_get(self):
+        self.client.login(username='admin', password='admin')
+        url = reverse('staff-schedule') + 'ics/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        talk = Talk.objects.get(accepted=True)
+        talk.duration = 90
+        talk.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
     def test_inexistent_format(self):
         self.client.login(username='admin', password='admin')
         self.assertEqual(self.client.get(reverse('staff-schedule') + 'inexistent/').status_code, 404)
+
+
+class TieredCacheTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_tiered_cache(self):
+        cache = TieredCache(self.dir, {})
+        other_process = FileBasedCache(self.dir, {})
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', ['value'])
+        self.assertEqual(cache.get('key'), ['value'])
+        value = cache.get('key')
+        self.assertEqual(value, ['value'])
+        value.append('modified')
+        self.assertEqual(cache.get('key'), ['value'])
+        self.assertEqual(other_process.get('key'), ['value'])
+        other_process.set('key', 'new value')
+        self.assertEqual(cache.get('key'), 'new value')
+        other_process.delete('key')
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache._tier.stats, {'misses': 2, 'file_hits': 2, 'local_hits': 2})
+
+    def test_stats(self):
+        cache = TieredCache(self.dir, {})
+        with mock.patch('ponyconf.cache.STATS_INTERVAL', 0):
+            cache.get('key')
+        stopped = subprocess.Popen([sys.executable, '-c', ''])
+        stopped.wait()
+        with open(os.path.join(self.dir, 'stats-%d.json' % stopped.pid), 'w') as f:
+            json.dump({'misses': 10}, f)
+        # the counters of stopped processes are dropped
+        self.assertEqual(cache.get_stats(), {'misses': 1})
+        self.assertEqual(os.listdir(self.dir), ['stats-%d.json' % os.getpid()])
+
+    def test_cull(self):
+        cache = TieredCache(self.dir, {'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_FREQUENCY': 2}})
+        cache.set('version', 'v1', None)
+        for i in range(20):
+            cache.set('key-%d' % i, i, 60 + i)
+        # the entries expiring first are culled, the entry without timeout is kept
+        self.assertEqual(cache.get('version'), 'v1')
+        self.assertIsNone(cache.get('key-0'))
+        self.assertEqual(cache.get('key-19'), 19)
@@ -58,6 +58,8 @@ urlpatterns = [
     path('staff/volunteers/<int:volunteer_id>/', views.volunteer_details, name='volunteer-details'),
     path('staff/volunteers/email/', views.volunteer_email, name='volunteer-email'),
     path('staff/volunteers/email/preview/', views.volunteer_email_preview, name='volunteer-email-preview'),
+    path('staff/search/', views.search, name='search'),
+    path('staff/stats/', views.request_stats, name='request-stats'),
     path('staff/add-user/', views.create_user, name='create-user'),
     re_path(r'^staff/schedule/((?P<program_format>[\w]+)/)?$', views.staff_schedule, name='staff-schedule'),
     path('staff/select2/', include('django_select2.urls')),
@@ -75,4 +77,6 @@ urlpatterns = [
     path('admin/activities/<slug:slug>/edit/', views.ActivityUpdate.as_view(), name='activity-edit'),
     path('admin/evict/', views.schedule_evict, name='schedule-evict'),
     re_path(r'^schedule/((?P<program_format>[\w]+)/)?$', views.public_schedule, name='public-schedule'),
+    path('schedule/json/days/<int:day>/', views.public_schedule, {'program_format': 'json'}, name='public-schedule-day'),
+    path('schedule/json/rooms/<slug:room>/', views.public_schedule, {'program_format': 'json'}, name='public-schedule-room'),
 ]
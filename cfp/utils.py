@@ -1,15 +1,77 @@
+from django.core.cache import cache
 from django.utils.crypto import get_random_string
-from django.db.models import Sum
+from django.db.models import F, Q, Sum
 from django.db.models.functions import Coalesce
 
+import pickle
+
+from .models import Conference
+
+
+CONFERENCE_VERSION_KEY = 'ponyconf-conference-version-%d'
+
+# site pk -> (version, pickled conference), only trusted while the shared version is unchanged
+_conferences = {}
+
 
 def query_sum(queryset, field):
     return queryset.aggregate(s=Coalesce(Sum(field), 0))['s']
 
 
+def keyset_page(queryset, key, descending=False, after=None, before=None, size=50):
+    """
+    Return a page of the queryset ordered by (key, pk), following the object of pk after
+    or preceding the object of pk before, with the pks to give as before and after to get
+    the previous and next pages (None when there is no such page).
+    """
+    queryset = queryset.annotate(sort_key=key)
+    backward = before is not None
+    cursor = before if backward else after
+    if cursor is not None:
+        value = list(queryset.filter(pk=cursor).values_list('sort_key', flat=True)[:1])
+        if value:
+            lookup = 'lt' if descending != backward else 'gt'
+            queryset = queryset.filter(Q(**{'sort_key__' + lookup: value[0]}) | Q(sort_key=value[0], **{'pk__' + lookup: cursor}))
+        else:
+            # the cursor object is gone or filtered out, start over
+            backward, cursor = False, None
+    if descending != backward:
+        queryset = queryset.order_by(F('sort_key').desc(), '-pk')
+    else:
+        queryset = queryset.order_by('sort_key', 'pk')
+    objects = list(queryset[:size + 1])
+    more = len(objects) > size
+    objects = objects[:size]
+    if not objects:
+        return objects, None, None
+    if backward:
+        objects.reverse()
+        return objects, objects[0].pk if more else None, objects[-1].pk
+    return objects, objects[0].pk if cursor is not None else None, objects[-1].pk if more else None
+
+
 def generate_user_uid():
     return get_random_string(length=12, allowed_chars='abcdefghijklmnopqrstuvwxyz0123456789')
 
+
+def generate_conference_version():
+    return get_random_string(12)
+
+
+def bump_conference_version(site_id):
+    cache.set(CONFERENCE_VERSION_KEY % site_id, generate_conference_version(), None)
+
+
+def get_conference(site):
+    version = cache.get_or_set(CONFERENCE_VERSION_KEY % site.pk, generate_conference_version, None)
+    cached = _conferences.get(site.pk)
+    if cached and cached[0] == version:
+        # each request gets its own copy as views may modify it
+        return pickle.loads(cached[1])
+    conference = Conference.objects.select_related('site').prefetch_related('staff').get(site=site)
+    _conferences[site.pk] = (version, pickle.dumps(conference))
+    return conference
+
   
 def is_staff(request, user):
-    return user.is_authenticated and (user.is_superuser or request.conference.staff.filter(pk=user.pk).exists())
+    return user.is_authenticated and (user.is_superuser or user.pk in {staff.pk for staff in request.conference.staff.all()})
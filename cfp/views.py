@@ -5,28 +5,34 @@ from django.urls import reverse, reverse_lazy
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import DeleteView, FormView, TemplateView
 from django.contrib import messages
-from django.db.models import Q, Count, Sum
+from django.db import transaction
+from django.db.models import Q, F, Case, When, Value, IntegerField, Count, Sum, prefetch_related_objects
 from django.views.generic import CreateView, DetailView, ListView, UpdateView
-from django.http import HttpResponse, Http404, HttpResponseServerError
+from django.http import HttpResponse, Http404, HttpResponseServerError, JsonResponse
 from django.utils import timezone
 from django.core.exceptions import PermissionDenied
 from django.core.mail import send_mail
 from django.forms import modelform_factory
 from django import forms
 from django.views.decorators.http import require_http_methods
-from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 
 from django_select2.views import AutoResponseView
 
 from functools import reduce
-import csv
 
 from mailing.forms import MessageForm
-from mailing.utils import send_message
-from .planning import Program
+from mailing.models import Message
+from mailing.utils import send_message, get_message_list
+from .planning import Program, evict_schedule
+from .search import SEARCH_LIMIT, search_filter
+from .actions import apply_talk_actions
+from .export import csv_response, participant_csv_rows, talk_csv_rows, volunteer_csv_rows
 from .decorators import speaker_required, volunteer_required, staff_required
 from .mixins import StaffRequiredMixin, OnSiteMixin, OnSiteFormMixin
-from .utils import is_staff
+from .utils import is_staff, keyset_page
+from .middleware import get_request_stats
 from .models import Participant, Talk, TalkCategory, Vote, Track, Tag, Room, Volunteer, Activity
 from .emails import talk_email_send, talk_email_render_preview, \
                     speaker_email_send, speaker_email_render_preview, \
@@ -39,7 +45,7 @@ from .forms import TalkForm, TalkStaffForm, TalkFilterForm, get_talk_speaker_for
                    PreviewTalkMailForm, PreviewSpeakerMailForm, PreviewVolunteerMailForm, \
                    SendTalkMailForm, SendSpeakerMailForm, SendVolunteerMailForm, \
                    TagForm, TalkCategoryForm, ActivityForm, \
-                   ACCEPTATION_VALUES, CONFIRMATION_VALUES
+                   ACCEPTATION_VALUES, CONFIRMATION_VALUES, TALK_PAGE_SIZES
 
 
 def home(request):
@@ -187,12 +193,7 @@ def volunteer_list(request):
             return redirect(reverse('volunteer-email'))
         return redirect(request.get_full_path())
     if request.GET.get('format') == 'csv':
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="volunteers.csv"'
-        writer = csv.writer(response)
-        for volunteer in volunteers:
-            writer.writerow(volunteer.get_csv_row())
-        return response
+        return csv_response(volunteer_csv_rows(volunteers), 'volunteers.csv')
     else:
         contact_link = 'mailto:' + ','.join([volunteer.email for volunteer in volunteers.all()])
         csv_query_dict = request.GET.copy()
@@ -224,8 +225,13 @@ def volunteer_details(request, volunteer_id):
         )
         messages.success(request, _('Message sent!'))
         return redirect(reverse('volunteer-details', args=[volunteer.pk]))
+    conversation, older_messages = get_message_list(request, volunteer.conversation)
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return render(request, 'mailing/_message_list.html', {'messages': conversation, 'older_messages': older_messages})
     return render(request, 'cfp/staff/volunteer_details.html', {
         'volunteer': volunteer,
+        'conversation': conversation,
+        'older_messages': older_messages,
     })
 
 
@@ -610,6 +616,11 @@ def staff(request):
     return render(request, 'cfp/staff/base.html')
 
 
+@staff_required
+def request_stats(request):
+    return JsonResponse({'views': get_request_stats(request.conference.site_id)})
+
+
 @staff_required
 def admin(request):
     return render(request, 'cfp/admin/base.html')
@@ -670,46 +681,17 @@ def talk_list(request):
                 talks = talks.exclude(video__exact='')
             else:
                 talks = talks.filter(video__exact='')
-    talks = talks.prefetch_related('category', 'speakers', 'track', 'tags')
-
     if request.GET.get('format') == 'csv':
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="talks.csv"'
-        writer = csv.writer(response)
-        for talk in talks:
-            writer.writerow(talk.get_csv_row())
-        return response
+        return csv_response(talk_csv_rows(talks), 'talks.csv')
 
     # Action
     action_form = TalkActionForm(request.POST or None, talks=talks, site=request.conference.site)
     if request.method == 'POST' and action_form.is_valid():
         data = action_form.cleaned_data
-        for talk_id in data['talks']:
-            talk = Talk.objects.get(site=request.conference.site, pk=talk_id)
-            if data['decision'] != None and data['decision'] != talk.accepted:
-                if data['decision']:
-                    action = _('accepted')
-                else:
-                    action = _('declined')
-                note = _('The talk has been %(action)s.') % {'action': action}
-                send_message(
-                    thread=talk.conversation,
-                    author=request.user,
-                    subject=_("[%(conference)s] The talk '%(talk)s' have been %(action)s") % {
-                        'conference': request.conference,
-                        'talk': talk,
-                        'action': action,
-                    },
-                    content=note,
-                )
-                talk.accepted = data['decision']
-            if data['track']:
-                talk.track = Track.objects.get(site=request.conference.site, slug=data['track'])
-            if data['tag']:
-                talk.tags.add(Tag.objects.get(site=request.conference.site, slug=data['tag']))
-            if data['room']:
-                talk.room = Room.objects.get(site=request.conference.site, slug=data['room'])
-            talk.save()
+        report = apply_talk_actions(request.conference, data['talks'], request.user, decision=data['decision'],
+                                    track=data['track'], tag=data['tag'], room=data['room'])
+        if any(report.values()):
+            messages.success(request, _('Talks updated: %(decision)d decisions, %(track)d tracks, %(tag)d tags and %(room)d rooms changed.') % report)
         if data['email']:
             email = int(data['email'])
             if email == TalkActionForm.EMAIL_TALKS:
@@ -727,21 +709,56 @@ def talk_list(request):
     else:
         sort_reverse = False
     SORT_MAPPING = {
-        'title': 'title',
-        'category': 'category',
-        'status': 'accepted',
+        'title': F('title'),
+        'category': F('category'),
+        'status': Case(When(accepted__isnull=True, then=Value(-1)), When(accepted=False, then=Value(0)),
+                       default=Value(1), output_field=IntegerField()),
+        'score': F('score'),
+        'votes': F('vote_count'),
+        'created': F('created'),
     }
     sort = request.GET.get('sort')
-    if sort in SORT_MAPPING.keys():
-        if sort_reverse:
-            talks = talks.order_by('-' + SORT_MAPPING[sort])
-        else:
-            talks = talks.order_by(SORT_MAPPING[sort])
+    if sort not in SORT_MAPPING.keys():
+        sort = None
+    # Pagination
+    try:
+        page_size = int(request.GET.get('page_size'))
+    except (TypeError, ValueError):
+        page_size = None
+    if page_size not in TALK_PAGE_SIZES:
+        page_size = TALK_PAGE_SIZES[1]
+    try:
+        after = int(request.GET['after'])
+    except (KeyError, ValueError):
+        after = None
+    try:
+        before = int(request.GET['before'])
+    except (KeyError, ValueError):
+        before = None
+    talk_count = talks.count()
+    talks, previous_talk, next_talk = keyset_page(talks.select_related('category', 'track'), SORT_MAPPING[sort or 'title'],
+                                                  descending=sort_reverse, after=after, before=before, size=page_size)
+    prefetch_related_objects(talks, 'speakers', 'tags')
+    page_urls = dict()
+    for name, pk in [('before', previous_talk), ('after', next_talk)]:
+        if pk is not None:
+            url = request.GET.copy()
+            url.pop('before', None)
+            url.pop('after', None)
+            url[name] = pk
+            page_urls[name] = url.urlencode()
+    page_size_urls = []
+    for size in TALK_PAGE_SIZES:
+        url = request.GET.copy()
+        url['page_size'] = size
+        page_size_urls.append((size, url.urlencode()))
     # Sorting URLs
     sort_urls = dict()
     sort_glyphicons = dict()
     for c in SORT_MAPPING.keys():
         url = request.GET.copy()
+        url.pop('before', None)
+        url.pop('after', None)
         url['sort'] = c
         if c == sort:
             if sort_reverse:
@@ -760,10 +777,14 @@ def talk_list(request):
     return render(request, 'cfp/staff/talk_list.html', {
         'show_filters': show_filters,
         'talk_list': talks,
+        'talk_count': talk_count,
         'filter_form': filter_form,
         'action_form': action_form,
         'sort_urls': sort_urls,
         'sort_glyphicons': sort_glyphicons,
+        'page_urls': page_urls,
+        'page_size': page_size,
+        'page_size_urls': page_size_urls,
         'csv_link': csv_link,
         'pending_email': bool(request.session.get('talk-email-list', None)),
     })
@@ -795,9 +816,14 @@ def talk_details(request, talk_id):
         )
         messages.success(request, _('Message sent!'))
         return redirect(reverse('talk-details', args=[talk.pk]))
+    conversation, older_messages = get_message_list(request, talk.conversation)
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return render(request, 'mailing/_message_list.html', {'messages': conversation, 'older_messages': older_messages})
     return render(request, 'cfp/staff/talk_details.html', {
         'talk': talk,
         'vote': vote,
+        'conversation': conversation,
+        'older_messages': older_messages,
     })
 
 
@@ -806,9 +832,12 @@ def talk_vote(request, talk_id, score):
     if score not in [-2, -1, 0, 1, 2]:
         raise Http404
     talk = get_object_or_404(Talk, pk=talk_id, site=request.conference.site)
-    vote, created = Vote.objects.get_or_create(talk=talk, user=request.user)
-    vote.vote = score
-    vote.save()
+    with transaction.atomic():
+        # the talk scores are computed again from all its votes, the concurrent votes must not miss each other
+        talk = Talk.objects.select_for_update().get(pk=talk.pk)
+        vote, created = Vote.objects.get_or_create(talk=talk, user=request.user)
+        vote.vote = score
+        vote.save()
     messages.success(request, _('Vote successfully created') if created else _('Vote successfully updated'))
     return redirect(talk.get_absolute_url())
 
@@ -897,7 +926,7 @@ def talk_email_preview(request):
 
 @staff_required
 def participant_list(request):
-    participants = Participant.objects.filter(site=request.conference.site) \
+    participants = Participant.objects.filter(site=request.conference.site).with_talk_counts() \
                                       .extra(select={'lower_name': 'lower(name)'}) \
                                       .order_by('lower_name')
     # Filtering
@@ -935,12 +964,7 @@ def participant_list(request):
             return redirect(reverse('speaker-email'))
         return redirect(request.get_full_path())
     if request.GET.get('format') == 'csv':
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="participants.csv"'
-        writer = csv.writer(response)
-        for participant in participants:
-            writer.writerow(participant.get_csv_row())
-        return response
+        return csv_response(participant_csv_rows(participants), 'participants.csv')
     else:
         contact_link = 'mailto:' + ','.join([participant.email for participant in participants.all()])
         csv_query_dict = request.GET.copy()
@@ -957,6 +981,25 @@ def participant_list(request):
         })
 
 
+@staff_required
+def search(request):
+    query = request.GET.get('q', '').strip()
+    site = request.conference.site
+    talks, participants, conversation = [], [], []
+    if query:
+        talks = search_filter(Talk.objects.filter(site=site).select_related('category'), query)[:SEARCH_LIMIT]
+        participants = search_filter(Participant.objects.filter(site=site), query)[:SEARCH_LIMIT]
+        conversation = Message.objects.filter(Q(thread__talk__site=site) | Q(thread__participant__site=site) | Q(thread__volunteer__site=site)) \
+                                      .select_related('thread__talk', 'thread__participant', 'thread__volunteer').with_authors()
+        conversation = search_filter(conversation, query)[:SEARCH_LIMIT]
+    return render(request, 'cfp/staff/search.html', {
+        'query': query,
+        'talks': talks,
+        'participants': participants,
+        'conversation': conversation,
+    })
+
+
 @staff_required
 def participant_details(request, participant_id):
     participant = get_object_or_404(Participant, pk=participant_id, site=request.conference.site)
@@ -972,8 +1015,13 @@ def participant_details(request, participant_id):
         )
         messages.success(request, _('Message sent!'))
         return redirect(reverse('participant-details', args=[participant.pk]))
+    conversation, older_messages = get_message_list(request, participant.conversation)
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return render(request, 'mailing/_message_list.html', {'messages': conversation, 'older_messages': older_messages})
     return render(request, 'cfp/staff/participant_details.html', {
         'participant': participant,
+        'conversation': conversation,
+        'older_messages': older_messages,
     })
 
 
@@ -1283,29 +1331,47 @@ def create_user(request):
     })
 
 
-def schedule(request, program_format, pending, template, staff, cache=None):
+def schedule(request, program_format, pending, template, staff, cache=None, day=None, room=None):
     program = Program(site=request.conference.site, pending=pending, staff=staff, cache=cache)
+    if program_format in ['html', 'xml', 'ics', 'json']:
+        # calendar clients and display screens poll these formats, answer them with 304 when nothing changed
+        if program_format == 'json':
+            etag = quote_etag(program.get_etag(program_format, day=day, room=room))
+        else:
+            etag = quote_etag(program.get_etag(program_format))
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            response['ETag'] = etag
+            return response
     if program_format is None:
         return render(request, template, {'program': program.render('html')})
     elif program_format == 'html':
-        return HttpResponse(program.render('html'))
+        response = HttpResponse(program.render('html'))
     elif program_format == 'xml':
-        return HttpResponse(program.render('xml'), content_type="application/xml")
+        response = HttpResponse(program.render('xml'), content_type="application/xml")
+    elif program_format == 'json':
+        content = program.render('json', day=day, room=room)
+        if content is None:
+            raise Http404
+        response = HttpResponse(content, content_type='application/json')
     elif program_format in ['ics', 'citymeo']:
         response = HttpResponse(program.render('ics', citymeo=bool(program_format == 'citymeo')), content_type='text/calendar')
         response['Content-Disposition'] = 'attachment; filename="planning.ics"'
-        return response
     else:
         raise Http404(_("Format '%s' not available" % program_format))
+    if program_format != 'citymeo':
+        response['ETag'] = etag
+    return response
 
 
-def public_schedule(request, program_format=None):
+def public_schedule(request, program_format=None, day=None, room=None):
     if not request.conference.schedule_available and not is_staff(request, request.user):
         raise PermissionDenied
     if request.conference.schedule_redirection_url and program_format is None:
         return redirect(request.conference.schedule_redirection_url)
     else:
-        return schedule(request, program_format=program_format, pending=False, template='cfp/schedule.html', staff=False)
+        return schedule(request, program_format=program_format, pending=False, template='cfp/schedule.html', staff=False,
+                        day=day, room=room)
 
 
 @staff_required
@@ -1315,7 +1381,7 @@ def staff_schedule(request, program_format=None):
 
 @staff_required
 def schedule_evict(request):
-    cache.clear()
+    evict_schedule(request.conference.site_id)
     messages.success(request, _('Schedule evicted from cache.'))
     return redirect('/')
 
@@ -1,6 +1,18 @@
 from django.contrib import admin
 
-from .models import Message
+from .models import Message, OutgoingEmail
+
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    # emails not sent after their last attempt are the ones to look at
+    list_display = ('__str__', 'subject', 'created', 'attempts', 'next_attempt', 'sent', 'last_error')
+    list_filter = (('sent', admin.EmptyFieldListFilter), 'attempts')
+    search_fields = ('subject',)
+    exclude = ('raw_message',)
+
+    def has_add_permission(self, request):
+        return False
 
 
 admin.site.register(Message)
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
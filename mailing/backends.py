@@ -0,0 +1,13 @@
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .models import OutgoingEmail
+
+
+class OutboxBackend(BaseEmailBackend):
+    """
+    Store emails in the outbox instead of sending them,
+    the sendoutbox management command delivers them with MAILING_OUTBOX_BACKEND.
+    """
+    def send_messages(self, email_messages):
+        OutgoingEmail.objects.bulk_create(map(OutgoingEmail.from_email_message, email_messages))
+        return len(email_messages)
@@ -12,12 +12,17 @@ class Command(BaseCommand):
         parser.add_argument('--user', required=True)
         parser.add_argument('--password', required=True)
         parser.add_argument('--inbox')
+        parser.add_argument('--batch-size', type=int, help='Number of emails fetched at once')
+        parser.add_argument('--workers', type=int, help='Number of threads parsing the emails')
         grp = parser.add_mutually_exclusive_group()
         grp.add_argument('--trash')
         grp.add_argument('--no-trash', action='store_true')
 
 
     def handle(self, *args, **options):
+        fetch_imap_box(**self.get_params(options))
+
+    def get_params(self, options):
         params = {
             'host': options['host'],
             'user': options['user'],
@@ -27,8 +32,12 @@ class Command(BaseCommand):
             params['port'] = options['port']
         if options['inbox']:
             params['inbox'] = options['inbox']
+        if options['batch_size']:
+            params['batch_size'] = options['batch_size']
+        if options['workers']:
+            params['workers'] = options['workers']
         if options['trash']:
             params['trash'] = options['trash']
         elif options['no_trash']:
             params['trash'] = None
-        fetch_imap_box(**params)
+        return params
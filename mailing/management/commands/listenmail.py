@@ -0,0 +1,19 @@
+from mailing.utils import listen_imap_box
+from .fetchmail import Command as FetchMailCommand
+
+
+class Command(FetchMailCommand):
+    help = 'Wait for emails on IMAP inbox and process them as they arrive'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--idle-timeout', type=int, help='Delay before renewing the IDLE command, in seconds')
+        parser.add_argument('--max-backoff', type=int, help='Maximum delay between reconnection attempts, in seconds')
+
+    def handle(self, *args, **options):
+        params = self.get_params(options)
+        if options['idle_timeout']:
+            params['idle_timeout'] = options['idle_timeout']
+        if options['max_backoff']:
+            params['max_backoff'] = options['max_backoff']
+        listen_imap_box(**params)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+import logging
+import time
+
+from mailing.utils import send_outbox, purge_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send emails waiting in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--max-attempts', type=int, default=10)
+        parser.add_argument('--backoff', type=int, default=60, help='Delay before the first retry, in seconds')
+        parser.add_argument('--loop', action='store_true', help='Keep waiting for new emails')
+        parser.add_argument('--interval', type=int, default=5, help='Delay between two outbox checks, in seconds')
+        parser.add_argument('--purge-after', type=int, metavar='DAYS',
+                            help='Delete the emails sent more than DAYS days ago')
+
+    def handle(self, *args, **options):
+        params = {
+            'batch_size': options['batch_size'],
+            'max_attempts': options['max_attempts'],
+            'backoff': options['backoff'],
+        }
+        while True:
+            try:
+                success, failure = send_outbox(**params)
+            except Exception:
+                if not options['loop']:
+                    raise
+                logging.exception("Unable to send the outbox")
+                success, failure = 0, 0
+            if success or failure:
+                self.stdout.write('%d email(s) sent, %d failure(s).' % (success, failure))
+            # the outbox is not empty while a whole batch was processed
+            if success + failure < options['batch_size']:
+                if options['purge_after'] is not None:
+                    purged = purge_outbox(options['purge_after'])
+                    if purged:
+                        self.stdout.write('%d sent email(s) deleted.' % purged)
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
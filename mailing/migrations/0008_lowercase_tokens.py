@@ -0,0 +1,22 @@
+# Generated by Django 3.1 on 2026-10-18 20:41
+
+from django.db import migrations
+from django.db.models.functions import Lower
+
+
+def forward(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    for model_name in ['MessageCorrespondent', 'MessageAuthor', 'MessageThread', 'Message']:
+        model = apps.get_model('mailing', model_name)
+        model.objects.using(db_alias).exclude(token=Lower('token')).update(token=Lower('token'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0007_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0008_lowercase_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingemail',
+            name='raw_message',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+    ]
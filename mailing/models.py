@@ -1,17 +1,24 @@
 from django.db import models
+from django.db.models import Q
 from django.utils.crypto import get_random_string
 from django.core.mail import EmailMessage, get_connection
+from django.core.mail.message import MIMEMixin
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+from collections import defaultdict
+from email import message_from_bytes
+from email.message import Message as MIMEMessage
 import hashlib
 
 
 def generate_message_token():
     # /!\ birthday problem
+    # lowercase only, as tokens received by email are lowercased before lookup
     return get_random_string(length=32, allowed_chars='abcdefghijklmnopqrstuvwxyz0123456789')
 
 
@@ -27,12 +34,38 @@ class MessageCorrespondent(models.Model):
     token = models.CharField(max_length=64, default=generate_message_token, unique=True)
 
 
+class MessageAuthorManager(models.Manager):
+    def get_or_create_for(self, objects):
+        """
+        Return the message authors of objects, indexed by (content type pk, object pk),
+        creating the missing ones in bulk.
+        """
+        pks = defaultdict(set)
+        for obj in objects:
+            pks[ContentType.objects.get_for_model(obj).pk].add(obj.pk)
+
+        def fetch():
+            q = Q(pk__in=[])
+            for author_type_id, author_ids in pks.items():
+                q |= Q(author_type_id=author_type_id, author_id__in=author_ids)
+            return dict(((author.author_type_id, author.author_id), author) for author in self.filter(q))
+        authors = fetch()
+        missing = [(author_type_id, author_id) for author_type_id, author_ids in pks.items()
+                   for author_id in author_ids if (author_type_id, author_id) not in authors]
+        if missing:
+            self.bulk_create([self.model(author_type_id=author_type_id, author_id=author_id) for author_type_id, author_id in missing])
+            authors = fetch()
+        return authors
+
+
 class MessageAuthor(models.Model):
     author_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True, blank=True)
     author_id = models.PositiveIntegerField(null=True, blank=True)
     author = GenericForeignKey('author_type', 'author_id')
     token = models.CharField(max_length=64, default=generate_message_token, unique=True)
 
+    objects = MessageAuthorManager()
+
     def __str__(self):
         author_class = self.author_type.model_class()
         if author_class == get_user_model():
@@ -45,13 +78,23 @@ class MessageThread(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     token = models.CharField(max_length=64, default=generate_message_token, unique=True)
 
+    def get_messages(self, before=None, count=20):
+        """
+        Return the last count messages posted before the given message pk, in chronological order,
+        and the pk to give as before to get the older messages, None if there are none.
+        """
+        messages = self.message_set.with_authors().order_by('-pk')
+        if before is not None:
+            messages = messages.filter(pk__lt=before)
+        messages = list(messages[:count + 1])
+        older = messages[count - 1].pk if len(messages) > count else None
+        return messages[:count][::-1], older
 
-class MessageManager(models.Manager):
-    def get_queyset(self):
-        qs = super().get_queryset()
-        # Does not work so well as prefetch_related is limited to one content type for generic foreign keys
-        qs = qs.prefetch_related('author__author')
-        return qs
+
+class MessageQuerySet(models.QuerySet):
+    def with_authors(self):
+        # authors are fetched with one query per content type
+        return self.select_related('author__author_type').prefetch_related('author__author')
 
 
 class Message(models.Model):
@@ -63,16 +106,22 @@ class Message(models.Model):
     content = models.TextField(blank=True)
     token = models.CharField(max_length=64, default=generate_message_token, unique=True)
 
-    objects = MessageManager()
+    objects = MessageQuerySet.as_manager()
 
     class Meta:
         ordering = ['created']
 
     def send_notification(self, sender, dests, reply_to=None, message_id=None, reference=None, footer=None, subject=None):
+        messages = self.get_notification(sender, dests, reply_to=reply_to, message_id=message_id, reference=reference,
+                                         footer=footer, subject=subject)
+        connection = get_connection()
+        connection.send_messages(messages)
+
+    def get_notification(self, sender, dests, reply_to=None, message_id=None, reference=None, footer=None, subject=None):
         messages = []
+        authors = MessageAuthor.objects.get_or_create_for([dest for dest, dest_name, dest_email in dests])
         for dest, dest_name, dest_email in dests:
-            dest_type = ContentType.objects.get_for_model(dest)
-            dest, _ = MessageAuthor.objects.get_or_create(author_type=dest_type, author_id=dest.pk)
+            dest = authors[ContentType.objects.get_for_model(dest).pk, dest.pk]
             token = self.token + dest.token + hexdigest_sha256(settings.SECRET_KEY, self.token, dest.token)[:16]
             if reply_to:
                 reply_to_name, reply_to_email = reply_to
@@ -99,8 +148,81 @@ class Message(models.Model):
                 reply_to=reply_to_list,
                 headers=headers,
             ))
-        connection = get_connection()
-        connection.send_messages(messages)
+        return messages
 
     def __str__(self):
         return _("Message from %(author)s") % {'author': str(self.author)}
+
+
+class StoredMIMEMessage(MIMEMixin, MIMEMessage):
+    pass
+
+
+class StoredEmailMessage(EmailMessage):
+    """Email sent as it was serialized when stored, whatever its alternatives and attachments."""
+    def __init__(self, raw_message, **kwargs):
+        super().__init__(**kwargs)
+        self.raw_message = raw_message
+
+    def message(self):
+        return message_from_bytes(self.raw_message, _class=StoredMIMEMessage)
+
+
+class OutgoingEmailQuerySet(models.QuerySet):
+    def due(self):
+        return self.filter(sent__isnull=True, next_attempt__lte=timezone.now())
+
+
+class OutgoingEmail(models.Model):
+    created = models.DateTimeField(auto_now_add=True)
+    from_email = models.CharField(max_length=1000)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    bcc = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list)
+    headers = models.JSONField(default=dict)
+    subject = models.TextField(blank=True)
+    body = models.TextField(blank=True)
+    raw_message = models.BinaryField(blank=True, default=b'')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    sent = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+
+    objects = OutgoingEmailQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['next_attempt', 'pk']
+
+    @classmethod
+    def from_email_message(cls, message):
+        return cls(
+            from_email=message.from_email,
+            to=list(message.to),
+            cc=list(message.cc),
+            bcc=list(message.bcc),
+            reply_to=list(message.reply_to),
+            headers=dict(message.extra_headers),
+            subject=message.subject,
+            body=message.body,
+            raw_message=message.message().as_bytes(),
+        )
+
+    def get_email_message(self, connection=None):
+        kwargs = dict(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email,
+            to=self.to,
+            cc=self.cc,
+            bcc=self.bcc,
+            reply_to=self.reply_to,
+            headers=self.headers,
+            connection=connection,
+        )
+        if self.raw_message:
+            return StoredEmailMessage(bytes(self.raw_message), **kwargs)
+        return EmailMessage(**kwargs)
+
+    def __str__(self):
+        return _("Email to %(to)s") % {'to': ', '.join(self.to + self.cc + self.bcc)}
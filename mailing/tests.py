@@ -2,10 +2,28 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.urls import reverse
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.core import mail
+from django.core.mail import send_mail, EmailMultiAlternatives
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 
-from .models import Message, MessageThread, MessageCorrespondent
+from collections import defaultdict
+from datetime import timedelta
+from email.message import EmailMessage
+from io import StringIO
+import socket
+import threading
+from unittest import mock
+
+from cfp.models import Participant
+
+from .models import Message, MessageThread, MessageCorrespondent, MessageAuthor, OutgoingEmail
+from .utils import send_message, fetch_imap_box, imap_idle, process_email, parse_email, CHARSET_DETECTION_SIZE
 
 
 #class MailingTests(TestCase):
@@ -91,3 +109,243 @@ from .models import Message, MessageThread, MessageCorrespondent
 #            p = Participation.objects.get(user=user, site=Site.objects.first())
 #            conv = ConversationWithParticipant.objects.get(participation=p)
 #            self.assertEqual(set([self.a, self.b]), set(conv.subscribers.all()))
+
+
+class FailingBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionRefusedError('SMTP server unavailable')
+
+
+@override_settings(EMAIL_BACKEND='mailing.backends.OutboxBackend',
+                   MAILING_OUTBOX_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class OutboxTests(TestCase):
+    def test_outbox(self):
+        send_mail('Subject', 'Body', 'from@example.org', ['to@example.org'])
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.to, email.sent), (['to@example.org'], None))
+        call_command('sendoutbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual((mail.outbox[0].subject, mail.outbox[0].body, mail.outbox[0].to), ('Subject', 'Body', ['to@example.org']))
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNotNone(email.sent)
+        call_command('sendoutbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_outbox_multipart(self):
+        email = EmailMultiAlternatives('Subject', 'Body', 'from@example.org', ['to@example.org'], bcc=['bcc@example.org'])
+        email.attach_alternative('<p>Body</p>', 'text/html')
+        email.attach('slides.pdf', b'%PDF', 'application/pdf')
+        email.send()
+        call_command('sendoutbox', stdout=StringIO())
+        self.assertEqual(mail.outbox[0].recipients(), ['to@example.org', 'bcc@example.org'])
+        message = mail.outbox[0].message()
+        self.assertEqual([part.get_content_type() for part in message.walk()],
+                         ['multipart/mixed', 'multipart/alternative', 'text/plain', 'text/html', 'application/pdf'])
+        self.assertIn(b'slides.pdf', message.as_bytes(linesep='\r\n'))
+
+    def test_outbox_purge(self):
+        send_mail('Subject', 'Body', 'from@example.org', ['to@example.org'])
+        call_command('sendoutbox', '--purge-after', '7', stdout=StringIO())
+        self.assertEqual(OutgoingEmail.objects.count(), 1)
+        OutgoingEmail.objects.update(sent=timezone.now() - timedelta(days=8))
+        out = StringIO()
+        call_command('sendoutbox', '--purge-after', '7', stdout=out)
+        self.assertIn('1 sent email(s) deleted.', out.getvalue())
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    def test_outbox_abandoned(self):
+        send_mail('Subject', 'Body', 'from@example.org', ['to@example.org'])
+        with override_settings(MAILING_OUTBOX_BACKEND='mailing.tests.FailingBackend'):
+            with self.assertLogs(level='ERROR') as logs:
+                call_command('sendoutbox', '--max-attempts', '1', stdout=StringIO())
+        self.assertIn('abandoned after 1 attempts', '\n'.join(logs.output))
+        User.objects.create_superuser('admin', 'admin@example.org', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('admin:mailing_outgoingemail_changelist') + '?sent__isempty=1')
+        self.assertContains(response, 'SMTP server unavailable')
+
+    def test_outbox_retry(self):
+        send_mail('Subject', 'Body', 'from@example.org', ['to@example.org'])
+        with override_settings(MAILING_OUTBOX_BACKEND='mailing.tests.FailingBackend'):
+            call_command('sendoutbox', '--backoff', '60', stdout=StringIO())
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNone(email.sent)
+        self.assertIn('SMTP server unavailable', email.last_error)
+        self.assertGreater(email.next_attempt, timezone.now() + timedelta(seconds=50))
+        call_command('sendoutbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+        OutgoingEmail.objects.update(next_attempt=timezone.now())
+        call_command('sendoutbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class FakeIMAP4:
+    def __init__(self, emails):
+        self.inbox = dict((str(uid).encode(), raw_email) for uid, raw_email in enumerate(emails, 1))
+        self.flags = defaultdict(set)
+        self.trash = []
+        self.commands = []
+        self.capabilities = ('IMAP4REV1', 'IDLE')
+        self.responses = []
+        self.sent = []
+        self.sock = mock.Mock()
+        self.tags = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def login(self, user, password):
+        return 'OK', [b'Logged in']
+
+    def enable(self, capability):
+        return 'OK', [b'Enabled']
+
+    def select(self, mailbox):
+        return 'OK', [str(len(self.inbox)).encode()]
+
+    def expunge(self):
+        for uid in [uid for uid in self.inbox if '\\Deleted' in self.flags[uid]]:
+            del self.inbox[uid]
+        return 'OK', [b'Expunged']
+
+    def _new_tag(self):
+        self.tags += 1
+        return b'A%03d' % self.tags
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def readline(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def uid(self, command, *args):
+        self.commands.append(command)
+        if command == 'search':
+            return 'OK', [b' '.join(self.inbox)]
+        uids = args[0].split(b',')
+        if command == 'fetch':
+            data = []
+            for seq, uid in enumerate(uids, 1):
+                data += [(b'%d (UID %s RFC822 {%d}' % (seq, uid, len(self.inbox[uid])), self.inbox[uid]), b')']
+            return 'OK', data
+        if command == 'copy':
+            self.trash += [self.inbox[uid] for uid in uids]
+        if command == 'store':
+            for uid in uids:
+                self.flags[uid].add(args[2])
+        return 'OK', [b'Done']
+
+
+class FetchMailTests(TestCase):
+    def setUp(self):
+        site = Site.objects.first()
+        conf = site.conference
+        conf.reply_email = 'ponyconf+{token}@example.org'
+        conf.contact_email = 'contact@example.org'
+        conf.save()
+        self.speaker = Participant.objects.create(site=site, name='Speaker', email='speaker@example.org')
+        send_message(self.speaker.conversation, conf, subject='Hello', content='Hello speaker')
+
+    def reply(self, to, content):
+        email = EmailMessage()
+        email['From'] = self.speaker.email
+        email['To'] = to
+        email['Subject'] = 'Re: Hello'
+        email.set_content(content)
+        return email.as_bytes()
+
+    def test_fetch_imap_box(self):
+        reply_to = mail.outbox[0].reply_to[0].split('<')[1].rstrip('>')
+        imap = FakeIMAP4([
+            self.reply(reply_to, 'First reply'),
+            self.reply('ponyconf@example.org', 'Lost reply'),
+            self.reply(reply_to, 'Second reply'),
+        ])
+        with mock.patch('mailing.utils.imaplib.IMAP4', return_value=imap):
+            fetch_imap_box('user', 'password', 'localhost', use_ssl=False, batch_size=2)
+        self.assertEqual(imap.commands.count('fetch'), 2)
+        replies = self.speaker.conversation.message_set.exclude(subject='Hello')
+        self.assertEqual(sorted(replies.values_list('content', flat=True)), ['First reply\n', 'Second reply\n'])
+        self.assertTrue(all(reply.author.author == self.speaker for reply in replies))
+        self.assertEqual(len(imap.trash), 2)
+        self.assertEqual(list(imap.inbox), [b'2'])
+        self.assertEqual(imap.flags[b'2'], {'NoTokenFound'})
+
+    def test_notification_authors(self):
+        message = self.speaker.conversation.message_set.get()
+        staff = [User.objects.create_user('staff%d' % i, email='staff%d@example.org' % i) for i in range(10)]
+        dests = [(user, user.username, user.email) for user in staff] + [(self.speaker, self.speaker.name, self.speaker.email)]
+        sender = ('PonyConf', 'contact@example.org')
+        # content types are cached for the process, do not depend on the tests run before
+        ContentType.objects.get_for_models(User, Participant)
+        with self.assertNumQueries(3):
+            notifications = message.get_notification(sender, dests, reply_to=('PonyConf', 'ponyconf+{token}@example.org'))
+        with self.assertNumQueries(1):
+            self.assertEqual([n.reply_to for n in message.get_notification(sender, dests, reply_to=('PonyConf', 'ponyconf+{token}@example.org'))],
+                             [n.reply_to for n in notifications])
+        self.assertEqual(notifications[-1].reply_to[0].split('<')[1], mail.outbox[0].reply_to[0].split('<')[1])
+        self.assertEqual(MessageAuthor.objects.filter(author_type__model='user', author_id__in=[user.pk for user in staff]).count(), 10)
+
+    def test_process_email_token_case(self):
+        local, domain = mail.outbox[0].reply_to[0].split('<')[1].rstrip('>').split('@')
+        with CaptureQueriesContext(connection) as queries:
+            process_email(self.reply('%s@%s' % (local.upper(), domain), 'Shouting reply'))
+        self.assertTrue(self.speaker.conversation.message_set.filter(content='Shouting reply\n').exists())
+        self.assertFalse(any('LIKE' in query['sql'] or 'UPPER' in query['sql'] for query in queries))
+
+    def test_parse_large_email(self):
+        reply_to = mail.outbox[0].reply_to[0].split('<')[1].rstrip('>')
+        email = EmailMessage()
+        email['To'] = reply_to
+        email.set_content('Reply with slides')
+        email.add_attachment(b'\0' * 3 * 1024 * 1024, maintype='application', subtype='pdf', filename='slides.pdf')
+        token, subject, content = parse_email(email.as_bytes(), max_size=64 * 1024)
+        self.assertEqual(content, 'Reply with slides\n')
+        raw_email = ('To: %s\r\nContent-Type: text/plain\r\n\r\n' % reply_to).encode() + 'Réponse\n'.encode('latin-1') * 100000
+        with mock.patch('mailing.utils.chardet.detect', return_value={'encoding': 'latin-1'}) as detect:
+            token, subject, content = parse_email(raw_email)
+        self.assertLessEqual(len(detect.call_args[0][0]), CHARSET_DETECTION_SIZE)
+        self.assertTrue(content.startswith('Réponse\n'))
+
+    def test_imap_idle(self):
+        imap = FakeIMAP4([])
+        imap.responses = [b'+ idling\r\n', b'* OK Still here\r\n', b'* 1 EXISTS\r\n', b'A001 OK Idle completed\r\n']
+        with mock.patch('mailing.utils.select.select', side_effect=lambda r, w, x, timeout: (r, w, x)):
+            self.assertTrue(imap_idle(imap, 60))
+        self.assertEqual(imap.sent, [b'A001 IDLE\r\n', b'DONE\r\n'])
+
+    def test_imap_idle_socket(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        imap = FakeIMAP4([])
+        imap.sock = client
+        imap.file = client.makefile('rb')
+        imap.readline = imap.file.readline
+        imap.send = client.sendall
+
+        def serve():
+            received = b''
+            for tag, notifications in [(b'A001', b''), (b'A002', b'* 2 EXISTS\r\n')]:
+                while not received.endswith(b'IDLE\r\n'):
+                    received += server.recv(1024)
+                server.sendall(b'+ idling\r\n' + notifications)
+                while not received.endswith(b'DONE\r\n'):
+                    received += server.recv(1024)
+                server.sendall(tag + b' OK Idle completed\r\n')
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        # the connection is still usable after an idle period without notification
+        self.assertFalse(imap_idle(imap, 0.1))
+        self.assertTrue(imap_idle(imap, 0.1))
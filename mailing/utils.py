@@ -1,17 +1,33 @@
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction, close_old_connections
+from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
+from django.core.mail import get_connection
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
 import imaplib
+import select
 import ssl
 import logging
+import time
 from email import policy
-from email.parser import BytesParser
+from email.parser import BytesFeedParser
 import chardet
 import re
 
 from cfp.models import User, Conference, Participant
-from .models import MessageThread, MessageCorrespondent, MessageAuthor, Message, hexdigest_sha256
+from .models import MessageThread, MessageCorrespondent, MessageAuthor, Message, OutgoingEmail, hexdigest_sha256
+
+
+FETCH_UID_REGEX = re.compile(rb'UID (?P<uid>\d+)')
+
+# larger emails are truncated, the reply is expected at the beginning
+MAX_EMAIL_SIZE = 1024 * 1024
+EMAIL_FEED_SIZE = 64 * 1024
+CHARSET_DETECTION_SIZE = 16 * 1024
 
 
 class NoTokenFoundException(Exception):
@@ -36,17 +52,127 @@ def send_message(thread, author, subject, content, in_reply_to=None):
     )
 
 
-def fetch_imap_box(user, password, host, port=993, use_ssl=True, inbox='INBOX', trash='Trash'):
-    logging.basicConfig(level=logging.DEBUG)
-    context = ssl.create_default_context()
+def get_message_list(request, thread):
+    """
+    Return a page of the thread messages, the older ones being requested with the before parameter,
+    and the value of before to get the previous page.
+    """
+    try:
+        before = int(request.GET['before'])
+    except (KeyError, ValueError):
+        before = None
+    return thread.get_messages(before=before)
+
+
+def send_bulk_messages(messages, get_notifications, batch_size=100):
+    """
+    Store (thread, author, subject, content) messages by batches and send the notifications
+    returned by get_notifications(message) through a single connection.
+    """
+    authors = dict()
+    sent = 0
+    messages = iter(messages)
+    with get_connection() as connection:
+        while True:
+            batch = []
+            for thread, author, subject, content in islice(messages, batch_size):
+                key = (type(author), author.pk)
+                if key not in authors:
+                    author_type = ContentType.objects.get_for_model(author)
+                    authors[key], _ = MessageAuthor.objects.get_or_create(author_type=author_type, author_id=author.pk)
+                    authors[key].author = author
+                batch.append(Message(thread=thread, author=authors[key], subject=subject, content=content))
+            if not batch:
+                break
+            Message.objects.bulk_create(batch)
+            notifications = []
+            for message in batch:
+                notifications += get_notifications(message)
+            connection.send_messages(notifications)
+            sent += len(batch)
+    return sent
+
+
+def send_outbox(batch_size=100, max_attempts=10, backoff=60):
+    """
+    Send a batch of due emails from the outbox with MAILING_OUTBOX_BACKEND.
+    Failed emails are retried later, the delay doubling at each attempt.
+    """
     success, failure = 0, 0
+    backend = getattr(settings, 'MAILING_OUTBOX_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+    with transaction.atomic():
+        emails = OutgoingEmail.objects.due().filter(attempts__lt=max_attempts).select_for_update(skip_locked=True)
+        emails = list(emails[:batch_size])
+        if not emails:
+            return success, failure
+        with get_connection(backend) as connection:
+            for email in emails:
+                email.attempts += 1
+                try:
+                    email.get_email_message(connection).send()
+                except Exception as e:
+                    failure += 1
+                    logging.exception("An error occured while sending an email from the outbox")
+                    email.last_error = str(e)
+                    email.next_attempt = timezone.now() + timedelta(seconds=backoff * 2 ** (email.attempts - 1))
+                    if email.attempts >= max_attempts:
+                        logging.error("Email %d (%s) abandoned after %d attempts: %s" % (email.pk, email, email.attempts, e))
+                else:
+                    success += 1
+                    email.sent = timezone.now()
+                email.save(update_fields=['attempts', 'last_error', 'next_attempt', 'sent'])
+    return success, failure
+
+
+def purge_outbox(days):
+    """Delete the emails sent more than days ago, and return their number."""
+    return OutgoingEmail.objects.filter(sent__lt=timezone.now() - timedelta(days=days)).delete()[0]
+
+
+def fetch_imap_box(user, password, host, port=993, use_ssl=True, inbox='INBOX', trash='Trash', batch_size=50, workers=4):
+    logging.basicConfig(level=logging.DEBUG)
+    with imap_connect(user, password, host, port, use_ssl, inbox, trash) as M:
+        success, failure = fetch_imap_emails(M, trash, batch_size, workers)
+    if failure:
+        total = success + failure
+        logging.info("Total: %d, success: %d, failure: %d" % (total, success, failure))
+
+
+def listen_imap_box(user, password, host, port=993, use_ssl=True, inbox='INBOX', trash='Trash', batch_size=50, workers=4,
+                    idle_timeout=29 * 60, max_backoff=300):
+    """
+    Process new emails as soon as the IMAP server notifies them (IDLE),
+    reconnecting with an increasing delay when the connection is lost.
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    backoff = 1
+    while True:
+        try:
+            with imap_connect(user, password, host, port, use_ssl, inbox, trash) as M:
+                if 'IDLE' not in M.capabilities:
+                    raise Exception('The IMAP server does not support IDLE')
+                backoff = 1
+                while True:
+                    close_old_connections()
+                    success, failure = fetch_imap_emails(M, trash, batch_size, workers)
+                    if success or failure:
+                        logging.info("Total: %d, success: %d, failure: %d" % (success + failure, success, failure))
+                    imap_idle(M, idle_timeout)
+        except (OSError, imaplib.IMAP4.error) as e:
+            logging.warning("IMAP connection lost (%s), reconnecting in %d seconds" % (e, backoff))
+            time.sleep(backoff)
+            backoff = min(2 * backoff, max_backoff)
+
+
+def imap_connect(user, password, host, port=993, use_ssl=True, inbox='INBOX', trash='Trash'):
     kwargs = {'host': host, 'port': port}
     if use_ssl:
         IMAP4 = imaplib.IMAP4_SSL
         kwargs.update({'ssl_context': ssl.create_default_context()})
     else:
         IMAP4 = imaplib.IMAP4
-    with IMAP4(**kwargs) as M:
+    M = IMAP4(**kwargs)
+    try:
         typ, data = M.login(user, password)
         if typ != 'OK':
             raise Exception(data[0].decode('utf-8'))
@@ -61,64 +187,167 @@ def fetch_imap_box(user, password, host, port=993, use_ssl=True, inbox='INBOX',
         typ, data = M.select(mailbox=inbox)
         if typ != 'OK':
             raise Exception(data[0].decode('utf-8'))
-        typ, data = M.uid('search', None, 'UNSEEN')
-        if typ != 'OK':
-            raise Exception(data[0].decode('utf-8'))
-        for num in data[0].split():
-            typ, data = M.uid('fetch', num, '(RFC822)')
-            if typ != 'OK':
-                failure += 1
-                logging.warning(data[0].decode('utf-8'))
-                continue
-            raw_email = data[0][1]
+    except Exception:
+        M.shutdown()
+        raise
+    return M
+
+
+def imap_idle(M, timeout):
+    """
+    Wait at most timeout seconds for a new email notification from the server.
+    imaplib supports IDLE only from python 3.14.
+    """
+    tag = M._new_tag()
+    M.send(tag + b' IDLE\r\n')
+    response = M.readline()
+    if not response.startswith(b'+'):
+        raise imaplib.IMAP4.error(response.decode('utf-8', 'replace'))
+    notified = False
+    deadline = time.monotonic() + timeout
+    while not notified:
+        remaining = deadline - time.monotonic()
+        # no socket timeout here: once timed out, the socket file cannot be read anymore
+        if remaining <= 0 or not _imap_wait(M, remaining):
+            break
+        response = M.readline()
+        if not response:
+            raise imaplib.IMAP4.abort('connection closed by the server')
+        notified = response.rstrip().endswith(b'EXISTS')
+    M.send(b'DONE\r\n')
+    while True:
+        response = M.readline()
+        if not response:
+            raise imaplib.IMAP4.abort('connection closed by the server')
+        if response.startswith(tag):
+            if not response.startswith(tag + b' OK'):
+                raise imaplib.IMAP4.error(response.decode('utf-8', 'replace'))
+            return notified
+        # a notification already buffered by the socket file is only read now
+        notified = notified or response.rstrip().endswith(b'EXISTS')
+
+
+def _imap_wait(M, timeout):
+    """Wait at most timeout seconds for data on the IMAP connection."""
+    if isinstance(M.sock, ssl.SSLSocket) and M.sock.pending():
+        return True
+    return bool(select.select([M.sock], [], [], timeout)[0])
+
+
+def fetch_imap_emails(M, trash='Trash', batch_size=50, workers=4):
+    success, failure = 0, 0
+    typ, data = M.uid('search', None, 'UNSEEN')
+    if typ != 'OK':
+        raise Exception(data[0].decode('utf-8'))
+    uids = iter(data[0].split())
+    # emails of a batch are parsed by the pool while the next batch is fetched
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parsing = None
+        while True:
+            batch = list(islice(uids, batch_size))
+            if batch:
+                raw_emails, fetch_failure = fetch_imap_batch(M, batch)
+                failure += fetch_failure
+            if parsing:
+                batch_success, batch_failure = store_imap_batch(M, parsing, trash)
+                success += batch_success
+                failure += batch_failure
+            if not batch:
+                break
+            parsing = [(uid, executor.submit(parse_email, raw_email)) for uid, raw_email in raw_emails]
+    typ, data = M.expunge()
+    if typ != 'OK':
+        failure += 1
+        raise Exception(data[0].decode('utf-8'))
+    return success, failure
+
+
+def fetch_imap_batch(M, uids):
+    typ, data = M.uid('fetch', b','.join(uids), '(UID BODY[]<0.%d>)' % MAX_EMAIL_SIZE)
+    if typ != 'OK':
+        logging.warning(data[0].decode('utf-8'))
+        return [], len(uids)
+    raw_emails, raw_email = dict(), None
+    # the UID may be given before or after the email literal
+    for item in data:
+        if isinstance(item, tuple):
+            header, raw_email = item
+        else:
+            header = item
+        m = FETCH_UID_REGEX.search(header or b'')
+        if m and raw_email is not None:
+            raw_emails[m.group('uid')] = raw_email
+            raw_email = None
+    fetched = [(uid, raw_emails[uid]) for uid in uids if uid in raw_emails]
+    return fetched, len(uids) - len(fetched)
+
+
+def store_imap_batch(M, parsing, trash):
+    success, failure = 0, 0
+    processed, tagged = [], defaultdict(list)
+    with transaction.atomic():
+        for uid, parsed in parsing:
             try:
-                process_email(raw_email)
+                with transaction.atomic():
+                    store_email(*parsed.result())
             except Exception as e:
                 failure += 1
                 logging.exception("An error occured during mail processing")
                 if type(e) == NoTokenFoundException:
                     tag = 'NoTokenFound'
-                if type(e) == InvalidTokenException:
+                elif type(e) == InvalidTokenException:
                     tag = 'InvalidToken'
-                if type(e) == InvalidKeyException:
+                elif type(e) == InvalidKeyException:
                     tag = 'InvalidKey'
                 else:
-                    print('Unexpected error:', e)
                     tag = 'UnknowError'
-                typ, data = M.uid('store', num, '+FLAGS', tag)
-                if typ != 'OK':
-                    logging.warning(data[0].decode('utf-8'))
-                continue
-            if trash is not None:
-                typ, data = M.uid('copy', num, trash)
-                if typ != 'OK':
-                    failure += 1
-                    logging.warning(data[0].decode('utf-8'))
-                    continue
-            typ, data = M.uid('store', num, '+FLAGS', '\Deleted')
-            if typ != 'OK':
-                failure += 1
-                logging.warning(data[0].decode('utf-8'))
-                continue
-            success += 1
-        typ, data = M.expunge()
+                tagged[tag].append(uid)
+            else:
+                processed.append(uid)
+    for tag, uids in tagged.items():
+        typ, data = M.uid('store', b','.join(uids), '+FLAGS', tag)
         if typ != 'OK':
-            failure += 1
-            raise Exception(data[0].decode('utf-8'))
-    if failure:
-        total = success + failure
-        logging.info("Total: %d, success: %d, failure: %d" % (total, success, failure))
+            logging.warning(data[0].decode('utf-8'))
+    if not processed:
+        return success, failure
+    if trash is not None:
+        typ, data = M.uid('copy', b','.join(processed), trash)
+        if typ != 'OK':
+            logging.warning(data[0].decode('utf-8'))
+            return success, failure + len(processed)
+    typ, data = M.uid('store', b','.join(processed), '+FLAGS', '\\Deleted')
+    if typ != 'OK':
+        logging.warning(data[0].decode('utf-8'))
+        return success, failure + len(processed)
+    return success + len(processed), failure
 
 
 def process_email(raw_email):
-    msg = BytesParser(policy=policy.default).parsebytes(raw_email)
+    store_email(*parse_email(raw_email))
+
+
+def parse_email(raw_email, max_size=MAX_EMAIL_SIZE):
+    """
+    Only the first max_size bytes of the email are parsed: replies come first,
+    attachments beyond are dropped, and only the text part is decoded.
+    """
+    start = time.perf_counter()
+    parser = BytesFeedParser(policy=policy.default)
+    size = min(len(raw_email), max_size)
+    for offset in range(0, size, EMAIL_FEED_SIZE):
+        parser.feed(raw_email[offset:min(offset + EMAIL_FEED_SIZE, size)])
+    msg = parser.close()
     body = msg.get_body(preferencelist=['plain'])
     content = body.get_payload(decode=True)
 
     charset = body.get_content_charset()
     if not charset:
-        charset = chardet.detect(content)['encoding']
-    content = content.decode(charset)
+        charset = chardet.detect(content[:CHARSET_DETECTION_SIZE])['encoding']
+    # a truncated email may end in the middle of a character
+    content = content.decode(charset, errors='replace')
+
+    logging.info("Email parsed in %.1f ms: %d bytes, %d parsed, %d characters of text" % (
+        1000 * (time.perf_counter() - start), len(raw_email), size, len(content)))
 
     regex = re.compile('^[^+@]+\+(?P<token>[a-zA-Z0-9]{80})@[^@]+$')
 
@@ -130,26 +359,31 @@ def process_email(raw_email):
     if not m:
         raise NoTokenFoundException
 
-    token = m.group('token')
+    # tokens are stored in lowercase, this allows exact (indexed) lookups
+    token = m.group('token').lower()
+
+    subject = msg.get('Subject', '')
+
+    return token, subject, content
 
+
+def store_email(token, subject, content):
     try:
         in_reply_to, author = process_new_token(token)
     except InvalidTokenException:
         in_reply_to, author = process_old_token(token)
 
-    subject = msg.get('Subject', '')
-
     Message.objects.create(thread=in_reply_to.thread, in_reply_to=in_reply_to, author=author, subject=subject, content=content)
 
 
 def process_new_token(token):
     try:
-        in_reply_to = Message.objects.get(token__iexact=token[:32])
-        author = MessageAuthor.objects.get(token__iexact=token[32:64])
+        in_reply_to = Message.objects.get(token=token[:32])
+        author = MessageAuthor.objects.get(token=token[32:64])
     except models.ObjectDoesNotExist:
         raise InvalidTokenException
 
-    if token[64:].lower() != hexdigest_sha256(settings.SECRET_KEY, in_reply_to.token, author.token)[:16]:
+    if token[64:] != hexdigest_sha256(settings.SECRET_KEY, in_reply_to.token, author.token)[:16]:
         raise InvalidKeyException
 
     return in_reply_to, author
@@ -157,12 +391,12 @@ def process_new_token(token):
 
 def process_old_token(token):
     try:
-        thread = MessageThread.objects.get(token__iexact=token[:32])
-        sender = MessageCorrespondent.objects.get(token__iexact=token[32:64])
+        thread = MessageThread.objects.get(token=token[:32])
+        sender = MessageCorrespondent.objects.get(token=token[32:64])
     except models.ObjectDoesNotExist:
         raise InvalidTokenException
 
-    if token[64:].lower() != hexdigest_sha256(settings.SECRET_KEY, thread.token, sender.token)[:16]:
+    if token[64:] != hexdigest_sha256(settings.SECRET_KEY, thread.token, sender.token)[:16]:
         raise InvalidKeyException
 
     in_reply_to = thread.message_set.last()
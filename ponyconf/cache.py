@@ -0,0 +1,194 @@
+from django.core.cache.backends.filebased import FileBasedCache
+
+from collections import OrderedDict, Counter
+from threading import Lock
+import glob
+import json
+import os
+import pickle
+import time
+import zlib
+
+
+STATS_INTERVAL = 10
+
+# cache directory -> in-process tier shared by the threads
+_tiers = {}
+_tiers_lock = Lock()
+
+
+class LocalTier:
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        # file name -> (file state, expiry, pickled value), the least recently used first
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.stats = Counter()
+        self.stats_saved = time.time()
+
+    def get(self, fname, state):
+        with self.lock:
+            entry = self.entries.get(fname)
+            if entry is None:
+                return None
+            if entry[0] != state or entry[1] < time.time():
+                del self.entries[fname]
+                return None
+            self.entries.move_to_end(fname)
+            return entry[2]
+
+    def set(self, fname, state, expiry, value):
+        with self.lock:
+            self.entries[fname] = (state, expiry, value)
+            self.entries.move_to_end(fname)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def forget(self, fname=None):
+        with self.lock:
+            if fname is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(fname, None)
+
+
+class TieredCache(FileBasedCache):
+    """
+    File based cache shared by the processes, the last used entries being also kept in memory.
+    The in-memory entries are only used while the cache file is unchanged, so they are never stale.
+
+    Options (besides the FileBasedCache ones): LOCAL_MAX_ENTRIES (default 1000) and LOCAL_TIMEOUT
+    (in seconds, default 300) bound the in-memory entries.
+
+    When MAX_ENTRIES is reached, the entries expiring first are culled, never the ones stored without timeout.
+
+    The hit and miss counters of each process are saved in the cache directory, see get_stats(); the files
+    of stopped processes are removed there.
+    """
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        options = params.get('OPTIONS', {})
+        with _tiers_lock:
+            if self._dir not in _tiers:
+                _tiers[self._dir] = LocalTier(int(options.get('LOCAL_MAX_ENTRIES', 1000)),
+                                              int(options.get('LOCAL_TIMEOUT', 300)))
+            self._tier = _tiers[self._dir]
+
+    def _count(self, stat):
+        tier = self._tier
+        with tier.lock:
+            tier.stats[stat] += 1
+            if tier.stats_saved + STATS_INTERVAL > time.time():
+                return
+            tier.stats_saved = time.time()
+            stats = dict(tier.stats)
+        try:
+            self._createdir()
+            with open(os.path.join(self._dir, 'stats-%d.json' % os.getpid()), 'w') as f:
+                json.dump(stats, f)
+        except OSError:
+            pass
+
+    def get(self, key, default=None, version=None):
+        fname = self._key_to_file(key, version)
+        try:
+            stat = os.stat(fname)
+        except FileNotFoundError:
+            self._tier.forget(fname)
+            self._count('misses')
+            return default
+        value = self._tier.get(fname, (stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        if value is not None:
+            self._count('local_hits')
+            return pickle.loads(value)
+        try:
+            with open(fname, 'rb') as f:
+                if self._is_expired(f):
+                    self._count('misses')
+                    return default
+                stat = os.fstat(f.fileno())
+                f.seek(0)
+                expiry = pickle.load(f)
+                value = zlib.decompress(f.read())
+        except FileNotFoundError:
+            self._count('misses')
+            return default
+        self._tier.set(fname, (stat.st_ino, stat.st_mtime_ns, stat.st_size),
+                       min(expiry or float('inf'), time.time() + self._tier.timeout), value)
+        self._count('file_hits')
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None, version=None):
+        super().set(key, value, timeout=timeout, version=version)
+        self._tier.forget(self._key_to_file(key, version))
+
+    def add(self, key, value, timeout=None, version=None):
+        self._tier.forget(self._key_to_file(key, version))
+        return super().add(key, value, timeout=timeout, version=version)
+
+    def touch(self, key, timeout=None, version=None):
+        self._tier.forget(self._key_to_file(key, version))
+        return super().touch(key, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        self._tier.forget(self._key_to_file(key, version))
+        return super().delete(key, version=version)
+
+    def clear(self):
+        super().clear()
+        self._tier.forget()
+
+    def _cull(self):
+        # unlike FileBasedCache, the entries without timeout (such as the site versions) are kept:
+        # culling them at random would make every cached page of the site outdated
+        filelist = self._list_cache_files()
+        num_entries = len(filelist)
+        if num_entries < self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            return self.clear()
+        expiring = []
+        for fname in filelist:
+            try:
+                with open(fname, 'rb') as f:
+                    expiry = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            if expiry is not None:
+                expiring.append((expiry, fname))
+        expiring.sort()
+        for expiry, fname in expiring[:int(num_entries / self._cull_frequency)]:
+            self._delete(fname)
+
+    def get_stats(self):
+        """Return the hit and miss counters summed over the running processes."""
+        stats = Counter()
+        for fname in glob.glob(os.path.join(self._dir, 'stats-*.json')):
+            try:
+                pid = int(os.path.basename(fname)[len('stats-'):-len('.json')])
+            except ValueError:
+                continue
+            if not _pid_alive(pid):
+                # counters of a stopped process, they would make the rates drift after each restart
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(fname) as f:
+                    stats.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return dict(stats)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
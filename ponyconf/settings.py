@@ -156,7 +156,12 @@ CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        'BACKEND': 'ponyconf.cache.TieredCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {
+            # a program is cached as a few entries per day and room
+            'MAX_ENTRIES': 10000,
+        },
     },
     'select2': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -166,6 +171,8 @@ CACHES = {
 
 SELECT2_CACHE_BACKEND = 'select2'
 
+TEST_RUNNER = 'ponyconf.testrunner.TestRunner'
+
 SERVER_EMAIL = 'ponyconf@example.com'
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'localhost'
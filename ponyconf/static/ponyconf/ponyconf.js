@@ -0,0 +1,7 @@
+$(document).on('click', 'a.load-older-messages', function (event) {
+  event.preventDefault();
+  var link = $(this);
+  $.get(link.attr('href'), function (html) {
+    link.parent().replaceWith(html);
+  });
+});